@@ -75,3 +75,28 @@ _WS_URL = {
         'retrieve': 'https://webservices.consulta.esocial.gov.br/servicos/empregador/consultarloteeventos/WsConsultarLoteEventos.svc?wsdl',
     }
 }
+
+
+# Used by WSClient(raw=True), which posts the SOAP envelope without zeep.
+_WS_SOAP = {
+    'send': {
+        'namespace': 'http://www.esocial.gov.br/servicos/empregador/lote/eventos/envio/v1_1_0',
+        'action': 'http://www.esocial.gov.br/servicos/empregador/lote/eventos/envio/v1_1_0/ServicoEnviarLoteEventos/EnviarLoteEventos',
+        'operation': 'EnviarLoteEventos',
+        'element': 'loteEventos',
+    },
+    'retrieve': {
+        'namespace': 'http://www.esocial.gov.br/servicos/empregador/lote/eventos/envio/consulta/retornoProcessamento/v1_1_0',
+        'action': 'http://www.esocial.gov.br/servicos/empregador/lote/eventos/envio/consulta/retornoProcessamento/v1_1_0/ServicoConsultarLoteEventos/ConsultarLoteEventos',
+        'operation': 'ConsultarLoteEventos',
+        'element': 'consulta',
+    },
+}
+
+
+def preload(versions=None, events=None, certs=None, builders=False):
+    """Load schemas, certificates and the XML signer before forking worker
+    processes. See `esocial.warmup.preload`.
+    """
+    from esocial.warmup import preload as _preload
+    return _preload(versions=versions, events=events, certs=certs, builders=builders)
@@ -13,6 +13,7 @@
 # limitations under the License.
 # ==============================================================================
 import os
+import re
 import datetime
 
 import requests
@@ -24,12 +25,14 @@ import esocial
 
 from esocial import xml
 from esocial.utils import pkcs12_data
+from esocial.throttle import default_throttle
 
 from zeep import (
     Client,
     xsd
 )
 from zeep.transports import Transport
+from zeep.exceptions import Fault, TransportError
 
 from lxml import etree
 
@@ -37,6 +40,11 @@ from lxml import etree
 here = os.path.abspath(os.path.dirname(__file__))
 serpro_ca_bundle = os.path.join(here, 'certs', 'serpro_chain_full.pem')
 
+SOAP_ENV_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+
+# Opening tag with optional prefix, attributes and namespace declarations
+_CD_RESPOSTA = re.compile(br'<(?:[\w.-]+:)?cdResposta(?:\s[^>]*)?>\s*([^<\s]*)\s*<')
+
 
 class CustomHTTPSAdapter(HTTPAdapter):
 
@@ -64,40 +72,130 @@ class CustomHTTPSAdapter(HTTPAdapter):
         return super(CustomHTTPSAdapter, self).proxy_manager_for(*args, **kwargs)
 
 
+class RawResponse(object):
+    """Response of a webservice call made with `WSClient(raw=True)`.
+
+    The body is kept as bytes (`content`) and only parsed when `envelope` or
+    `result` are accessed.
+    """
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+        self._envelope = None
+
+    @property
+    def envelope(self):
+        """The SOAP envelope as a lxml Element."""
+        if self._envelope is None:
+            self._envelope = etree.fromstring(self.content)
+        return self._envelope
+
+    @property
+    def result(self):
+        """The eSocial return element (what the zeep client returns)."""
+        body = self.envelope.find('{{{}}}Body'.format(SOAP_ENV_NS))
+        if body is None:
+            return None
+        # Body/<operation>Response/<operation>Result/eSocial
+        found = body.xpath('*/*/*')
+        return found[0] if found else None
+
+    def response_code(self):
+        """The first cdResposta of the response, read without parsing it."""
+        found = _CD_RESPOSTA.search(self.content)
+        if found is None:
+            return None
+        return found.group(1).decode('ascii')
+
+
 class WSClient(object):
+    # Maximum events per batch accepted by eSocial
+    max_batch_size = 50
 
     def __init__(self, employer_id=None, sender_id=None, pfx_file=None, pfx_passw=None,
-                 ca_file=serpro_ca_bundle, target=esocial._TARGET):
+                 ca_file=serpro_ca_bundle, target=esocial._TARGET, throttle=None, raw=False,
+                 timeout=60):
         self.ca_file = ca_file
         if pfx_file is not None:
             self.cert_data = pkcs12_data(pfx_file, pfx_passw)
         else:
             self.cert_data = None
         self.batch = []
-        self.event_ids = []
-        self.max_batch_size = 50
+        self._id_sequence = {}
         self.employer_id = employer_id
         self.sender_id = sender_id
         self.target = target
+        self.throttle = throttle if throttle is not None else default_throttle()
+        self.raw = raw
+        # Seconds to wait for the webservices to answer
+        self.timeout = timeout
+        self._session = None
 
-    def _connect(self, url):
-        transport_session = requests.Session()
-        transport_session.mount(
-            'https://',
-            CustomHTTPSAdapter(
-                ctx_options={
-                    'cert': self.cert_data['cert'],
-                    'key': self.cert_data['key'],
-                    'cafile': self.ca_file
-                }
+    def _http_session(self):
+        # One pooled mutual TLS session per client
+        if self._session is None:
+            transport_session = requests.Session()
+            transport_session.mount(
+                'https://',
+                CustomHTTPSAdapter(
+                    ctx_options={
+                        'cert': self.cert_data['cert'],
+                        'key': self.cert_data['key'],
+                        'cafile': self.ca_file
+                    }
+                )
             )
-        )
-        ws_transport = Transport(session=transport_session)
+            self._session = transport_session
+        return self._session
+
+    def _connect(self, url):
+        ws_transport = Transport(session=self._http_session(), operation_timeout=self.timeout)
         return Client(
             url,
             transport=ws_transport
         )
 
+    def _soap_envelop(self, which, envelop):
+        soap = esocial._WS_SOAP[which]
+        return b''.join([
+            b'<?xml version="1.0" encoding="utf-8"?>',
+            b'<soap:Envelope xmlns:soap="', SOAP_ENV_NS.encode('ascii'), b'" xmlns:ws="',
+            soap['namespace'].encode('ascii'), b'"><soap:Body><ws:', soap['operation'].encode('ascii'),
+            b'><ws:', soap['element'].encode('ascii'), b'>',
+            envelop,
+            b'</ws:', soap['element'].encode('ascii'), b'></ws:', soap['operation'].encode('ascii'),
+            b'></soap:Body></soap:Envelope>',
+        ])
+
+    def _post_raw(self, which, envelop):
+        """POST the serialized `envelop` (bytes) to the `which` webservice,
+        without zeep, and return a RawResponse.
+        """
+        url = esocial._WS_URL[self.target][which].split('?')[0]
+        response = self._http_session().post(
+            url,
+            data=self._soap_envelop(which, envelop),
+            headers={
+                'Content-Type': 'text/xml; charset=utf-8',
+                'SOAPAction': '"{}"'.format(esocial._WS_SOAP[which]['action']),
+            },
+            timeout=self.timeout
+        )
+        if response.status_code != 200:
+            if b'Fault' in response.content:
+                fault = RawResponse(response.content, response.status_code).envelope
+                raise Fault(
+                    fault.findtext('.//faultstring'),
+                    code=fault.findtext('.//faultcode')
+                )
+            raise TransportError(status_code=response.status_code, content=response.content)
+        return RawResponse(response.content, response.status_code)
+
+    def _cert_id(self):
+        if self.cert_data is None:
+            return None
+        return self.cert_data['cert'].digest('sha256')
+
     def _check_nrinsc(self, employer_id):
         if employer_id.get('use_full') or employer_id.get('tpInsc') == 2:
             return employer_id['nrInsc']
@@ -109,13 +207,15 @@ class WSClient(object):
             self._check_nrinsc(self.employer_id),
             datetime.datetime.now().strftime('%Y%m%d%H%M%S')
         )
-        self.event_ids.append(id_prefix)
-        Q = self.event_ids.count(id_prefix)
-        return '{}{:0>5}'.format(id_prefix, Q)
+        # The sequence survives clear_batch(): Ids must be unique for the
+        # employer, not only inside one batch
+        if id_prefix not in self._id_sequence:
+            self._id_sequence = {id_prefix: 0}
+        self._id_sequence[id_prefix] += 1
+        return '{}{:0>5}'.format(id_prefix, self._id_sequence[id_prefix])
 
     def clear_batch(self):
         self.batch = []
-        self.event_ids = []
 
     def add_event(self, event):
         if not isinstance(event, etree._ElementTree):
@@ -215,22 +315,34 @@ class WSClient(object):
         self.validate_envelop('send', batch_to_send)
         # If no exception, batch XML is valid
         url = esocial._WS_URL[self.target]['send']
-        ws = self._connect(url)
-        # ws.wsdl.dump()
-        BatchElement = ws.get_element('ns1:EnviarLoteEventos')
-        result = ws.service.EnviarLoteEventos(BatchElement(loteEventos=batch_to_send))
-        del ws
+        if self.raw:
+            batch_bytes = etree.tostring(batch_to_send)
+            return self.throttle.call('send', self._cert_id(), self._post_raw, 'send', batch_bytes)
+
+        def _send():
+            ws = self._connect(url)
+            # ws.wsdl.dump()
+            BatchElement = ws.get_element('ns1:EnviarLoteEventos')
+            result = ws.service.EnviarLoteEventos(BatchElement(loteEventos=batch_to_send))
+            del ws
+            return result
         # Result is a lxml Element object
-        return result
+        return self.throttle.call('send', self._cert_id(), _send)
 
     def retrieve(self, protocol_number):
         batch_to_search = self._make_retrieve_envelop(protocol_number)
         self.validate_envelop('retrieve', batch_to_search)
         # if no exception, protocol XML is valid
         url = esocial._WS_URL[self.target]['retrieve']
-        ws = self._connect(url)
-        # ws.wsdl.dump()
-        SearchElement = ws.get_element('ns1:ConsultarLoteEventos')
-        result = ws.service.ConsultarLoteEventos(SearchElement(consulta=batch_to_search))
-        del ws
-        return result
+        if self.raw:
+            search_bytes = etree.tostring(batch_to_search)
+            return self.throttle.call('retrieve', self._cert_id(), self._post_raw, 'retrieve', search_bytes)
+
+        def _retrieve():
+            ws = self._connect(url)
+            # ws.wsdl.dump()
+            SearchElement = ws.get_element('ns1:ConsultarLoteEventos')
+            result = ws.service.ConsultarLoteEventos(SearchElement(consulta=batch_to_search))
+            del ws
+            return result
+        return self.throttle.call('retrieve', self._cert_id(), _retrieve)
@@ -0,0 +1,567 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Typed event builders generated from the eSocial XSD files.
+
+For each event XSD (esocial/xsd/v<version>/evt*.xsd) this module generates
+Python source with one `__slots__` class per complex element of the schema.
+Fields are kept in schema order, with their QNames already computed, so
+building an event is a few attribute writes and one serialization pass:
+
+    from esocial import codegen
+
+    evt = codegen.event_module('evtMonit')
+    root = evt.ESocial(evtMonit=evt.EvtMonit(ideEvento=..., ...))
+    xml_doc = root.to_tree()
+
+Errors are caught before any XSD validation. Assigning a misspelled field
+raises AttributeError, and assigning a simple value outside its facets
+(enumeration, pattern, length, ranges) or an element of the wrong class
+raises ValueError. Checks that depend on the whole node (missing required
+elements, occurrence counts, choices) and items appended to lists after the
+assignment are checked when the tree is built, also raising ValueError.
+
+The generated source can also be written to disk:
+
+    python -m esocial.codegen output_dir [--version 2.5.00] [evtMonit ...]
+"""
+import os
+import re
+import sys
+import types
+import argparse
+import threading
+
+from decimal import Decimal, InvalidOperation
+
+import six
+
+from lxml import etree
+
+from esocial import __esocial_version__
+
+
+XS = '{http://www.w3.org/2001/XMLSchema}'
+
+here = os.path.abspath(os.path.dirname(__file__))
+
+
+class Simple(object):
+    """Facets of a simple (text) XSD type.
+    """
+    __slots__ = (
+        'base', 'enumeration', 'pattern', 'length', 'min_length', 'max_length',
+        'fraction_digits', 'min_inclusive', 'max_inclusive', '_regex',
+    )
+
+    def __init__(self, base, enumeration=None, pattern=None, length=None, min_length=None,
+                 max_length=None, fraction_digits=None, min_inclusive=None, max_inclusive=None):
+        self.base = base
+        self.enumeration = frozenset(enumeration) if enumeration else None
+        self.pattern = pattern
+        self.length = length
+        self.min_length = min_length
+        self.max_length = max_length
+        self.fraction_digits = fraction_digits
+        self.min_inclusive = Decimal(min_inclusive) if min_inclusive is not None else None
+        self.max_inclusive = Decimal(max_inclusive) if max_inclusive is not None else None
+        # XSD patterns are implicitly anchored
+        self._regex = re.compile(u'^(?:{})$'.format(pattern), re.UNICODE) if pattern else None
+
+    def text(self, value, path):
+        """Convert `value` to its XML text, checking the facets.
+        """
+        if self.base == 'date' and hasattr(value, 'strftime'):
+            text = value.strftime('%Y-%m-%d')
+        elif self.base == 'dateTime' and hasattr(value, 'isoformat'):
+            text = value.isoformat()
+        elif isinstance(value, float) and self.fraction_digits is not None:
+            text = u'{:.{}f}'.format(value, self.fraction_digits)
+        else:
+            text = six.text_type(value)
+        if self.enumeration is not None and text not in self.enumeration:
+            raise ValueError(u'{}: "{}" is not one of {}'.format(path, text, sorted(self.enumeration)))
+        if self._regex is not None and self._regex.match(text) is None:
+            raise ValueError(u'{}: "{}" does not match pattern "{}"'.format(path, text, self.pattern))
+        size = len(text)
+        if self.length is not None and size != self.length:
+            raise ValueError(u'{}: length must be {}'.format(path, self.length))
+        if self.min_length is not None and size < self.min_length:
+            raise ValueError(u'{}: length must be at least {}'.format(path, self.min_length))
+        if self.max_length is not None and size > self.max_length:
+            raise ValueError(u'{}: length must be at most {}'.format(path, self.max_length))
+        if self.min_inclusive is not None or self.max_inclusive is not None:
+            try:
+                number = Decimal(text)
+            except InvalidOperation:
+                raise ValueError(u'{}: "{}" is not a number'.format(path, text))
+            if self.min_inclusive is not None and number < self.min_inclusive:
+                raise ValueError(u'{}: must be >= {}'.format(path, self.min_inclusive))
+            if self.max_inclusive is not None and number > self.max_inclusive:
+                raise ValueError(u'{}: must be <= {}'.format(path, self.max_inclusive))
+        return text
+
+
+class Node(object):
+    """Base class of the generated event classes.
+
+    Class attributes set by the generated code:
+
+    _attributes: tuple of (name, required, Simple)
+    _fields: tuple of (name, qname, min_occurs, max_occurs, Simple or Node subclass),
+        in schema order. max_occurs is None when unbounded.
+    _choices: tuple of (required, branches), each branch a tuple of (name, min_occurs)
+    _qname, _nsmap: only on the root (eSocial) class
+    """
+    __slots__ = ()
+    _attributes = ()
+    _fields = ()
+    _choices = ()
+    _qname = None
+    _nsmap = None
+
+    def __init__(self, **kwargs):
+        for name in kwargs:
+            setattr(self, name, kwargs[name])
+
+    def __setattr__(self, name, value):
+        if value is not None:
+            spec = self._index().get(name)
+            if spec is not None:
+                self._check_value(name, value, *spec)
+        super(Node, self).__setattr__(name, value)
+
+    @classmethod
+    def _index(cls):
+        # name -> (path, max_occurs, Simple or Node subclass), built once per class
+        index = cls.__dict__.get('_index_cache')
+        if index is None:
+            index = {}
+            for name, _, simple in cls._attributes:
+                index[name] = ('{}/@{}'.format(cls.__name__, name), 1, simple)
+            for name, _, _, max_occurs, kind in cls._fields:
+                index[name] = ('{}/{}'.format(cls.__name__, name), max_occurs, kind)
+            cls._index_cache = index
+        return index
+
+    def _check_value(self, name, value, path, max_occurs, kind):
+        if max_occurs != 1:
+            if not isinstance(value, (list, tuple)):
+                raise ValueError('{}: a list is expected'.format(path))
+            values = value
+        else:
+            values = (value,)
+        for item in values:
+            if isinstance(kind, Simple):
+                kind.text(item, path)
+            elif not isinstance(item, kind):
+                raise ValueError('{}: {} expected, got {}'.format(
+                    path, kind.__name__, item.__class__.__name__
+                ))
+
+    def __repr__(self):
+        values = [
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self.__slots__ if getattr(self, name, None) is not None
+        ]
+        return '{}({})'.format(self.__class__.__name__, ', '.join(values))
+
+    def _check_choices(self, path):
+        for required, branches in self._choices:
+            chosen = [
+                branch for branch in branches
+                if any(getattr(self, name, None) is not None for name, _ in branch)
+            ]
+            if len(chosen) > 1:
+                raise ValueError('{}: only one of {} may be set'.format(
+                    path, ', '.join('/'.join(name for name, _ in branch) for branch in chosen)
+                ))
+            if not chosen:
+                if required:
+                    raise ValueError('{}: one of {} is required'.format(
+                        path, ', '.join('/'.join(name for name, _ in branch) for branch in branches)
+                    ))
+                continue
+            for name, min_occurs in chosen[0]:
+                if min_occurs and getattr(self, name, None) is None:
+                    raise ValueError('{}/{}: element is required'.format(path, name))
+
+    def build(self, element, path=''):
+        """Write attributes and children of this node into the lxml `element`.
+        """
+        path = path or self.__class__.__name__
+        for name, required, simple in self._attributes:
+            value = getattr(self, name, None)
+            if value is None:
+                if required:
+                    raise ValueError('{}/@{}: attribute is required'.format(path, name))
+                continue
+            element.set(name, simple.text(value, '{}/@{}'.format(path, name)))
+        if self._choices:
+            self._check_choices(path)
+        SubElement = etree.SubElement
+        for name, qname, min_occurs, max_occurs, kind in self._fields:
+            value = getattr(self, name, None)
+            if value is None:
+                values = ()
+            elif max_occurs != 1:
+                if not isinstance(value, (list, tuple)):
+                    raise ValueError('{}/{}: a list is expected'.format(path, name))
+                values = value
+            else:
+                values = (value,)
+            count = len(values)
+            if count < min_occurs:
+                raise ValueError('{}/{}: at least {} expected, got {}'.format(path, name, min_occurs, count))
+            if max_occurs is not None and count > max_occurs:
+                raise ValueError('{}/{}: at most {} expected, got {}'.format(path, name, max_occurs, count))
+            for i, item in enumerate(values):
+                item_path = '{}/{}'.format(path, name) if count == 1 else '{}/{}[{}]'.format(path, name, i)
+                child = SubElement(element, qname)
+                if isinstance(kind, Simple):
+                    child.text = kind.text(item, item_path)
+                elif isinstance(item, kind):
+                    item.build(child, item_path)
+                else:
+                    raise ValueError('{}: {} expected, got {}'.format(
+                        item_path, kind.__name__, item.__class__.__name__
+                    ))
+        return element
+
+    def to_element(self):
+        """Serialize the root node into a lxml Element.
+        """
+        if self._qname is None:
+            raise ValueError('{} is not a root element.'.format(self.__class__.__name__))
+        return self.build(etree.Element(self._qname, nsmap=self._nsmap))
+
+    def to_tree(self):
+        """Serialize the root node into a lxml ElementTree, ready for
+        `esocial.xml.sign` or `esocial.client.WSClient.add_event`.
+        """
+        return etree.ElementTree(self.to_element())
+
+
+# ------------------------------------------------------------------------------
+# XSD reading
+
+
+class _ClassSpec(object):
+
+    def __init__(self, name, doc=None):
+        self.name = name
+        self.doc = doc
+        self.attributes = []
+        self.fields = []
+        self.choices = []
+
+
+def _documentation(el):
+    doc = el.find('{0}annotation/{0}documentation'.format(XS))
+    if doc is None:
+        simple = el.find('{}simpleType'.format(XS))
+        if simple is not None:
+            doc = simple.find('{0}annotation/{0}documentation'.format(XS))
+    if doc is not None and doc.text:
+        return ' '.join(doc.text.split())
+    return None
+
+
+def _max_occurs(el):
+    value = el.get('maxOccurs', '1')
+    if value == 'unbounded':
+        return None
+    return int(value)
+
+
+def _builtin(type_name):
+    return type_name.split(':', 1)[1]
+
+
+def _simple_from_restriction(restriction):
+    facets = {}
+    enumeration = []
+    for facet in restriction:
+        if not isinstance(facet.tag, six.string_types):
+            continue
+        tag = etree.QName(facet).localname
+        value = facet.get('value')
+        if tag == 'enumeration':
+            enumeration.append(value)
+        elif tag == 'pattern':
+            facets['pattern'] = value
+        elif tag == 'length':
+            facets['length'] = int(value)
+        elif tag == 'minLength':
+            facets['min_length'] = int(value)
+        elif tag == 'maxLength':
+            facets['max_length'] = int(value)
+        elif tag == 'fractionDigits':
+            facets['fraction_digits'] = int(value)
+        elif tag == 'minInclusive':
+            facets['min_inclusive'] = value
+        elif tag == 'maxInclusive':
+            facets['max_inclusive'] = value
+    if enumeration:
+        facets['enumeration'] = enumeration
+    return (_builtin(restriction.get('base')), facets)
+
+
+class _SchemaReader(object):
+
+    def __init__(self, xsd_file):
+        self.xsd_file = xsd_file
+        self.doc = etree.parse(xsd_file)
+        schema = self.doc.getroot()
+        self.target_ns = schema.get('targetNamespace')
+        self.named_types = {}
+        for complex_type in schema.findall('{}complexType'.format(XS)):
+            self.named_types[complex_type.get('name')] = complex_type
+        self.classes = []
+        self.class_names = set()
+        self._named_specs = {}
+        root = schema.find('{}element'.format(XS))
+        self.root_name = root.get('name')
+        self.root = self._complex(root.find('{}complexType'.format(XS)), self._class_name(self.root_name))
+        self.event = self.root.fields[0][4] if self.root.fields else None
+
+    def qname(self, name):
+        return u'{{{}}}{}'.format(self.target_ns, name)
+
+    def _class_name(self, element_name, parent=None):
+        name = element_name[0].upper() + element_name[1:]
+        if name in self.class_names and parent is not None:
+            name = parent + name
+        candidate = name
+        i = 1
+        while candidate in self.class_names:
+            i += 1
+            candidate = '{}{}'.format(name, i)
+        self.class_names.add(candidate)
+        return candidate
+
+    def _named(self, type_name):
+        if type_name not in self._named_specs:
+            self.class_names.add(type_name)
+            self._named_specs[type_name] = self._complex(self.named_types[type_name], type_name)
+        return self._named_specs[type_name]
+
+    def _complex(self, complex_type, class_name, doc=None):
+        spec = _ClassSpec(class_name, doc)
+        for child in complex_type:
+            self._content(spec, child, spec.fields)
+        # Children are emitted before their parents
+        self.classes.append(spec)
+        return spec
+
+    def _content(self, spec, item, target, in_choice=False):
+        if not isinstance(item.tag, six.string_types):
+            return
+        tag = etree.QName(item).localname
+        if tag == 'sequence':
+            for child in item:
+                self._content(spec, child, target, in_choice)
+        elif tag == 'choice':
+            branches = []
+            for child in item:
+                if not isinstance(child.tag, six.string_types) or etree.QName(child).localname == 'annotation':
+                    continue
+                branch = []
+                self._content(spec, child, branch, in_choice=True)
+                branches.append(tuple((field[0], field[2]) for field in branch))
+                # Occurrences inside a choice are checked by Node._check_choices
+                target.extend((name, qname, 0, max_occurs, kind) for name, qname, _, max_occurs, kind in branch)
+            required = item.get('minOccurs', '1') != '0' and not in_choice
+            spec.choices.append((required, tuple(branches)))
+        elif tag == 'element':
+            field = self._element(spec, item)
+            if field is not None:
+                target.append(field)
+        elif tag == 'attribute':
+            # Ids are set by WSClient.add_event
+            required = item.get('use') == 'required' and item.get('type') != 'xs:ID'
+            if item.get('type'):
+                simple = (_builtin(item.get('type')), {})
+            else:
+                simple = _simple_from_restriction(item.find('{0}simpleType/{0}restriction'.format(XS)))
+            spec.attributes.append((item.get('name'), required, simple))
+
+    def _element(self, parent, el):
+        if el.get('ref') is not None:
+            # ds:Signature is added when signing
+            return None
+        name = el.get('name')
+        min_occurs = int(el.get('minOccurs', '1'))
+        max_occurs = _max_occurs(el)
+        type_name = el.get('type')
+        if type_name is not None:
+            if type_name.startswith('xs:'):
+                kind = (_builtin(type_name), {})
+            else:
+                kind = self._named(type_name)
+        else:
+            simple_type = el.find('{}simpleType'.format(XS))
+            if simple_type is not None:
+                kind = _simple_from_restriction(simple_type.find('{}restriction'.format(XS)))
+            else:
+                kind = self._complex(
+                    el.find('{}complexType'.format(XS)),
+                    self._class_name(name, parent.name),
+                    _documentation(el)
+                )
+        return (name, self.qname(name), min_occurs, max_occurs, kind)
+
+
+# ------------------------------------------------------------------------------
+# Source generation
+
+
+def _simple_source(simple):
+    base, facets = simple
+    args = [repr(base)]
+    for key in sorted(facets):
+        value = facets[key]
+        if key == 'enumeration':
+            value = tuple(value)
+        args.append('{}={!r}'.format(key, value))
+    return 'Simple({})'.format(', '.join(args))
+
+
+def _tuple_source(items, indent):
+    if not items:
+        return '()'
+    pad = ' ' * indent
+    lines = ['(']
+    for item in items:
+        lines.append('{}    {},'.format(pad, item))
+    lines.append('{})'.format(pad))
+    return '\n'.join(lines)
+
+
+def generate_source(xsd_file):
+    """Return the Python source of the builder classes for one event XSD.
+    """
+    reader = _SchemaReader(xsd_file)
+    simples = {}
+    simple_lines = []
+
+    def simple_name(simple):
+        source = _simple_source(simple)
+        if source not in simples:
+            simples[source] = '_S{}'.format(len(simples))
+            simple_lines.append('{} = {}'.format(simples[source], source))
+        return simples[source]
+
+    class_blocks = []
+    for spec in reader.classes:
+        lines = ['class {}(Node):'.format(spec.name)]
+        if spec.doc:
+            lines.append('    {!r}'.format(spec.doc))
+        slots = [a[0] for a in spec.attributes] + [f[0] for f in spec.fields]
+        lines.append('    __slots__ = {!r}'.format(tuple(slots)))
+        if spec.attributes:
+            attributes = [
+                '({!r}, {!r}, {})'.format(name, required, simple_name(simple))
+                for name, required, simple in spec.attributes
+            ]
+            lines.append('    _attributes = {}'.format(_tuple_source(attributes, 4)))
+        if spec.fields:
+            fields = []
+            for name, qname, min_occurs, max_occurs, kind in spec.fields:
+                if isinstance(kind, _ClassSpec):
+                    kind_source = kind.name
+                else:
+                    kind_source = simple_name(kind)
+                fields.append('({!r}, {!r}, {!r}, {!r}, {})'.format(
+                    name, qname, min_occurs, max_occurs, kind_source
+                ))
+            lines.append('    _fields = {}'.format(_tuple_source(fields, 4)))
+        if spec.choices:
+            lines.append('    _choices = {!r}'.format(tuple(spec.choices)))
+        if spec is reader.root:
+            lines.append('    _qname = {!r}'.format(reader.qname(reader.root_name)))
+            lines.append('    _nsmap = {{None: {!r}}}'.format(reader.target_ns))
+        class_blocks.append('\n'.join(lines))
+
+    header = [
+        '# -*- coding: utf-8 -*-',
+        '# Generated by esocial.codegen from {}. Do not edit.'.format(
+            os.path.join(*xsd_file.split(os.sep)[-2:])
+        ),
+        'from esocial.codegen import Node, Simple',
+        '',
+        'NAMESPACE = {!r}'.format(reader.target_ns),
+        '',
+    ]
+    footer = [
+        'ROOT = {}'.format(reader.root.name),
+        'EVENT = {}'.format(reader.event.name if isinstance(reader.event, _ClassSpec) else None),
+        '',
+    ]
+    return '\n'.join(header + simple_lines + ['', ''] + ['\n\n\n'.join(class_blocks), '', ''] + footer)
+
+
+def xsd_file(event, version=None):
+    version = version or __esocial_version__
+    return os.path.join(here, 'xsd', 'v{}'.format(version), '{}.xsd'.format(event))
+
+
+def events(version=None):
+    """Return the names of the events available for an eSocial version.
+    """
+    version = version or __esocial_version__
+    xsd_dir = os.path.join(here, 'xsd', 'v{}'.format(version))
+    return sorted(f[:-4] for f in os.listdir(xsd_dir) if f.startswith('evt') and f.endswith('.xsd'))
+
+
+_modules = {}
+_modules_lock = threading.Lock()
+
+
+def event_module(event, version=None):
+    """Return a module with the builder classes of `event` (e.g. 'evtMonit').
+
+    The source is generated and compiled on the first call and cached for the
+    life of the process.
+    """
+    version = version or __esocial_version__
+    key = (version, event)
+    with _modules_lock:
+        if key not in _modules:
+            source = generate_source(xsd_file(event, version))
+            module_name = 'esocial.codegen.v{}.{}'.format(version.replace('.', '_'), event)
+            module = types.ModuleType(module_name)
+            code = compile(source, '<{}>'.format(module_name), 'exec')
+            six.exec_(code, module.__dict__)
+            _modules[key] = module
+        return _modules[key]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate eSocial event builder classes.')
+    parser.add_argument('output_dir')
+    parser.add_argument('events', nargs='*', help='Events to generate (default: all).')
+    parser.add_argument('--version', default=__esocial_version__)
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    for event in args.events or events(args.version):
+        source = generate_source(xsd_file(event, args.version))
+        with open(os.path.join(args.output_dir, '{}.py'.format(event)), 'wb') as fp:
+            fp.write(source.encode('utf-8'))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,360 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Dispatch events to several worker processes, sharded by employer.
+
+eSocial requires the events of an employer to be sent in order within each
+group (1 - table events, 2 - non-periodic events, 3 - periodic events, the
+`grupo` attribute of the batch). `Dispatcher` routes every employer to
+always the same worker process, so that order is kept, while different
+employers are signed, validated and sent in parallel. When an event or a
+batch of an (employer, group) pair fails, the later events of the pair are
+not sent until the caller calls `Dispatcher.unblock` and submits them again.
+
+Events cross the process boundary as serialized XML. On platforms that fork,
+call `esocial.preload` before creating the Dispatcher so the workers start
+with schemas and certificates already loaded.
+"""
+import time
+import zlib
+import multiprocessing
+
+from collections import deque, OrderedDict
+
+from six.moves import queue as Queue
+
+from lxml import etree
+
+from esocial import xml
+from esocial.client import WSClient, RawResponse
+from esocial.throttle import Throttle, default_throttle, set_default_throttle, response_code
+
+
+def _employer_key(employer_id):
+    # Same identity WSClient uses for the batch envelope and the event Ids
+    return (
+        int(employer_id['tpInsc']),
+        str(employer_id['nrInsc']),
+        bool(employer_id.get('use_full')),
+    )
+
+
+def _flush(key, employer_id, events, blocked, clients, results, client_class, client_kwargs):
+    (employer_key, group_id) = key
+    errors = []
+    event_ids = []
+    unsent = []
+    result = None
+    if key in blocked:
+        errors.append('Not sent, an earlier event of this employer and group failed: {}'.format(blocked[key]))
+        unsent = list(events)
+    else:
+        try:
+            client = clients.get(employer_key)
+            if client is None:
+                client = client_class(employer_id=employer_id, **client_kwargs)
+                # One client per employer, so event Ids keep their sequence
+                # across batches
+                clients[employer_key] = client
+            client.clear_batch()
+            for i, event in enumerate(events):
+                try:
+                    client.add_event(xml.load_frombytes(event))
+                except Exception as e:
+                    errors.append(repr(e))
+                    # The events after a rejected one must not overtake it
+                    unsent = events[i:]
+                    break
+            event_ids = [event.getroot().getchildren()[0].get('Id') for event in client.batch]
+            if client.batch:
+                result = client.send(group_id=group_id)
+                code = response_code(result)
+                if code is not None and not code.startswith('2'):
+                    # Batch refused by eSocial
+                    errors.append('cdResposta {}'.format(code))
+                    unsent = list(events)
+                    event_ids = []
+                if isinstance(result, RawResponse):
+                    result = result.content
+                elif result is not None:
+                    result = etree.tostring(result)
+        except Exception as e:
+            errors.append(repr(e))
+            unsent = list(events)
+            event_ids = []
+        if unsent:
+            blocked[key] = errors[-1]
+    results.put({
+        'employer_id': employer_id,
+        'group_id': group_id,
+        'event_ids': event_ids,
+        'result': result,
+        'errors': errors,
+        'unsent': unsent,
+    })
+
+
+def _worker(tasks, results, received, processed, oldest, client_class, client_kwargs,
+            max_batch_size, linger, throttle_settings):
+    # Each worker gets its share of the parent's rate limits
+    set_default_throttle(Throttle(**throttle_settings))
+    clients = {}
+    # (employer, group) -> error message of the failure that blocked it
+    blocked = {}
+    # key -> (flush deadline, employer_id, events, first submit time), in
+    # deadline order
+    pending = OrderedDict()
+
+    def update_oldest():
+        oldest.value = min(entry[3] for entry in pending.values()) if pending else 0.0
+
+    def flush(key):
+        # The batch stays pending while it is sent, so stats() counts its lag
+        _, employer_id, events, _ = pending[key]
+        _flush(key, employer_id, events, blocked, clients, results, client_class, client_kwargs)
+        del pending[key]
+        update_oldest()
+        with processed.get_lock():
+            processed.value += len(events)
+
+    while True:
+        timeout = None
+        if pending:
+            timeout = max(0, next(iter(pending.values()))[0] - time.time())
+        try:
+            item = tasks.get(timeout=timeout)
+        except Queue.Empty:
+            item = False
+        if item is None:
+            for key in list(pending):
+                flush(key)
+            break
+        if item is not False:
+            employer_id, group_id, event, submitted = item
+            key = (_employer_key(employer_id), group_id)
+            if event is None:
+                # Dispatcher.unblock: events submitted before it are still
+                # reported as not sent
+                if key in pending:
+                    flush(key)
+                blocked.pop(key, None)
+            else:
+                if key not in pending:
+                    pending[key] = (time.time() + linger, employer_id, [], submitted)
+                    update_oldest()
+                pending[key][2].append(event)
+                with received.get_lock():
+                    received.value += 1
+                if len(pending[key][2]) >= max_batch_size:
+                    flush(key)
+        now = time.time()
+        for key in [k for k in pending if pending[k][0] <= now]:
+            flush(key)
+
+
+class Dispatcher(object):
+    """Send events through `workers` processes, partitioned by employer and group.
+
+    All events of an employer go to the same worker, which keeps one WSClient
+    per employer. The worker batches the events of each (employer, group)
+    pair and sends a batch when it reaches `max_batch_size` events or
+    `linger` seconds after its first event. Each batch produces one result
+    dict with the keys 'employer_id' (as given to `submit`), 'group_id',
+    'event_ids', 'result' (serialized response XML or None), 'errors' (list
+    of error messages, including failures to create the client) and
+    'unsent' (serialized events not sent, in submission order).
+
+    An event rejected by the client, a failed send or a batch refused by
+    eSocial blocks its (employer, group) pair: the rest of the batch and all
+    later events of the pair come back in 'unsent'. Call `unblock` and then
+    submit them again.
+
+    Each worker installs a `Throttle` with 1/`workers` of the rates of
+    `throttle`, so the per certificate limits hold for all workers together
+    (when some workers are idle the others do not use their share).
+
+    Parameters
+    ----------
+    workers: int
+        Number of worker processes (shards).
+    client_kwargs: dict
+        Keyword arguments for the `WSClient` of each employer, except
+        employer_id (pfx_file, pfx_passw, sender_id, target...).
+    max_batch_size: int
+        Maximum events per batch, up to the `max_batch_size` of
+        `client_class` (50, the eSocial limit, for WSClient).
+    linger: float
+        Seconds a batch waits for more events before being sent.
+    client_class: class
+        WSClient or a compatible class.
+    throttle: esocial.throttle.Throttle, optional
+        Limits to split among the workers. Defaults to
+        `esocial.throttle.default_throttle()`.
+    """
+    def __init__(self, workers=2, client_kwargs=None, max_batch_size=50, linger=0.5, client_class=WSClient,
+                 throttle=None):
+        limit = getattr(client_class, 'max_batch_size', None)
+        if max_batch_size < 1 or (limit is not None and max_batch_size > limit):
+            raise ValueError('max_batch_size must be between 1 and {}.'.format(limit))
+        throttle = throttle if throttle is not None else default_throttle()
+        self.workers = workers
+        self._closed = False
+        self._results = multiprocessing.Queue()
+        self._tasks = []
+        self._received = []
+        self._processed = []
+        self._oldest = []
+        self._submitted = []
+        self._submit_times = []
+        self._accounted = []
+        self._processes = []
+        for _ in range(workers):
+            tasks = multiprocessing.Queue()
+            received = multiprocessing.Value('l', 0)
+            processed = multiprocessing.Value('l', 0)
+            oldest = multiprocessing.Value('d', 0.0)
+            process = multiprocessing.Process(
+                target=_worker,
+                args=(
+                    tasks, self._results, received, processed, oldest, client_class, client_kwargs or {},
+                    max_batch_size, linger, throttle.settings(workers)
+                )
+            )
+            process.daemon = True
+            process.start()
+            self._tasks.append(tasks)
+            self._received.append(received)
+            self._processed.append(processed)
+            self._oldest.append(oldest)
+            self._submitted.append(0)
+            self._submit_times.append(deque())
+            self._accounted.append(0)
+            self._processes.append(process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def shard(self, employer_id):
+        """Return the worker index for an employer.
+        """
+        key = '{}:{}:{}'.format(*_employer_key(employer_id))
+        return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % self.workers
+
+    def submit(self, employer_id, event, group_id=1):
+        """Queue an event (lxml ElementTree, not signed) to be sent.
+        """
+        if not isinstance(event, etree._ElementTree):
+            raise ValueError('Not an ElementTree instance!')
+        if self._closed:
+            raise Exception('Dispatcher is closed!')
+        shard = self.shard(employer_id)
+        now = time.time()
+        self._tasks[shard].put((dict(employer_id), int(group_id), etree.tostring(event), now))
+        self._submitted[shard] += 1
+        self._submit_times[shard].append(now)
+        return shard
+
+    def unblock(self, employer_id, group_id=1):
+        """Let the (employer, group) pair send again after a failure.
+
+        Events submitted before this call are still returned as not sent.
+        """
+        if self._closed:
+            raise Exception('Dispatcher is closed!')
+        self._tasks[self.shard(employer_id)].put((dict(employer_id), int(group_id), None, None))
+
+    def stats(self):
+        """Return queue depth and lag of each shard.
+
+        'depth' is the number of submitted events not yet sent, and 'lag' the
+        age, in seconds, of the oldest of them (0 if there is none).
+        """
+        now = time.time()
+        stats = []
+        for shard in range(self.workers):
+            # The worker counts an event as received only after it is part of
+            # the oldest pending time, so read received first
+            received = self._received[shard].value
+            oldest = self._oldest[shard].value
+            processed = self._processed[shard].value
+            times = self._submit_times[shard]
+            while self._accounted[shard] < received and times:
+                times.popleft()
+                self._accounted[shard] += 1
+            # Oldest of the batches held by the worker and the events still
+            # in its queue
+            candidates = [t for t in (oldest, times[0] if times else 0.0) if t]
+            stats.append({
+                'shard': shard,
+                'submitted': self._submitted[shard],
+                'processed': processed,
+                'depth': self._submitted[shard] - processed,
+                'lag': now - min(candidates) if candidates else 0.0,
+                'alive': self._processes[shard].is_alive(),
+            })
+        return stats
+
+    def get_result(self, timeout=None):
+        """Wait for the next result. Raises Queue.Empty on timeout.
+        """
+        return self._results.get(timeout=timeout)
+
+    def results(self):
+        """Return the results available now, without waiting.
+        """
+        available = []
+        while True:
+            try:
+                available.append(self._results.get(block=False))
+            except Queue.Empty:
+                return available
+
+    def close(self):
+        """Send the pending events, stop the workers and return the results
+        not yet collected. Workers that died with events not sent are
+        reported as results with 'shard' and an error message.
+        """
+        if self._closed:
+            return self.results()
+        self._closed = True
+        for tasks in self._tasks:
+            tasks.put(None)
+        remaining = []
+        while any(process.is_alive() for process in self._processes):
+            # The results queue must be drained for the workers to exit
+            try:
+                remaining.append(self._results.get(timeout=0.1))
+            except Queue.Empty:
+                pass
+        for process in self._processes:
+            process.join()
+        remaining.extend(self.results())
+        for stats in self.stats():
+            if stats['depth']:
+                # The worker died before sending everything it received
+                remaining.append({
+                    'shard': stats['shard'],
+                    'employer_id': None,
+                    'group_id': None,
+                    'event_ids': [],
+                    'result': None,
+                    'unsent': [],
+                    'errors': ['Worker {} exited (code {}) with {} events not sent.'.format(
+                        stats['shard'], self._processes[stats['shard']].exitcode, stats['depth']
+                    )],
+                })
+        return remaining
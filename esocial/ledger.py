@@ -0,0 +1,353 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Columnar ledger of sent events and their processing results.
+
+A `Ledger` keeps one row per event, in compact typed columns:
+
+- event Id and receipt number (nrRecibo) as fixed width bytes;
+- employer (nrInsc), event type and period (perApur) as interned codes;
+- the eSocial response code (cdResposta, 0 while not processed);
+- the occurrence codes of each event, in two parallel columns.
+
+Rows are added when events are sent (`add_batch`) and completed from the
+`WSClient.retrieve` results (`add_retrieve`), through a hash index on the
+event Id. `summary` aggregates acceptance per employer, event type and
+period (vectorized with NumPy, when it is installed), and `save`/`load`
+store the columns as raw files that can be memory mapped.
+"""
+import os
+import sys
+import json
+import mmap
+
+from array import array
+from collections import defaultdict
+
+from lxml import etree
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+ID_SIZE = 36
+RECIBO_SIZE = 40
+
+# cdResposta of a processed event: 201 - success, 202 - success with warnings
+ACCEPTED_CODES = (201, 202)
+
+_INT_COLUMNS = ('employer', 'event_type', 'period', 'cd_resposta', 'occ_row', 'occ_code')
+_GROUP_COLUMNS = ('employer', 'event_type', 'period')
+
+
+def _fixed(value, size, what):
+    if not isinstance(value, bytes):
+        value = value.encode('ascii')
+    if len(value) > size:
+        raise ValueError('{} "{}" is longer than {} characters.'.format(what, value.decode('ascii'), size))
+    return value.ljust(size, b'\0')
+
+
+def _text(element, path):
+    found = element.find(path)
+    if found is None or found.text is None:
+        return None
+    return found.text.strip()
+
+
+def _load_bytes(column_file, mmap_mode):
+    with open(column_file, 'rb') as fp:
+        if mmap_mode and os.path.getsize(column_file):
+            access = mmap.ACCESS_READ if mmap_mode == 'r' else mmap.ACCESS_COPY
+            return mmap.mmap(fp.fileno(), 0, access=access)
+        # Empty files can not be mapped
+        return bytearray(fp.read())
+
+
+class Ledger(object):
+    """Columnar store of events and their eSocial results.
+    """
+    def __init__(self):
+        self.ids = bytearray()
+        self.recibos = bytearray()
+        for column in _INT_COLUMNS:
+            setattr(self, column, array('i'))
+        self.employers = []
+        self.event_types = []
+        self.periods = ['']
+        self._codes = {
+            'employer': {},
+            'event_type': {},
+            'period': {'': 0},
+        }
+        self._index = None
+        self._occ_index = None
+
+    def __len__(self):
+        return len(self.cd_resposta)
+
+    def _tables(self):
+        return {'employer': self.employers, 'event_type': self.event_types, 'period': self.periods}
+
+    def _intern(self, column, value):
+        codes = self._codes[column]
+        code = codes.get(value)
+        if code is None:
+            table = self._tables()[column]
+            code = len(table)
+            table.append(value)
+            codes[value] = code
+        return code
+
+    def _row_index(self):
+        if self._index is None:
+            ids = memoryview(self.ids)
+            self._index = dict(
+                (ids[i:i + ID_SIZE].tobytes(), row)
+                for row, i in enumerate(range(0, len(ids), ID_SIZE))
+            )
+        return self._index
+
+    def _occurrence_index(self):
+        # row -> occurrence codes, built once from the occurrence columns
+        if self._occ_index is None:
+            index = defaultdict(list)
+            for row, code in zip(self.occ_row, self.occ_code):
+                index[int(row)].append(int(code))
+            self._occ_index = index
+        return self._occ_index
+
+    def find(self, event_id):
+        """Return the row of an event Id, or None.
+        """
+        return self._row_index().get(_fixed(event_id, ID_SIZE, 'Event Id'))
+
+    def add(self, event_id, employer, event_type, period=None):
+        """Record a sent event and return its row. Events already in the
+        ledger keep their row.
+        """
+        key = _fixed(event_id, ID_SIZE, 'Event Id')
+        index = self._row_index()
+        row = index.get(key)
+        if row is not None:
+            return row
+        row = len(self)
+        self.ids.extend(key)
+        self.recibos.extend(b'\0' * RECIBO_SIZE)
+        self.employer.append(self._intern('employer', employer or ''))
+        self.event_type.append(self._intern('event_type', event_type or ''))
+        self.period.append(self._intern('period', period or ''))
+        self.cd_resposta.append(0)
+        index[key] = row
+        return row
+
+    def add_batch(self, batch):
+        """Record the (signed) events of a batch, e.g. `WSClient.batch`,
+        before calling `WSClient.send`.
+        """
+        for event in batch:
+            if isinstance(event, etree._ElementTree):
+                event = event.getroot()
+            evt = event.getchildren()[0]
+            self.add(
+                evt.get('Id'),
+                _text(evt, '{*}ideEmpregador/{*}nrInsc'),
+                etree.QName(evt).localname,
+                _text(evt, '{*}ideEvento/{*}perApur'),
+            )
+
+    def update(self, event_id, cd_resposta, nr_recibo=None, occurrences=(), employer=None):
+        """Store the result of an event. Unknown events are added first.
+        """
+        row = self.find(event_id)
+        if row is None:
+            row = self.add(event_id, employer, None)
+        if self.cd_resposta[row] == 0 and occurrences:
+            for code in occurrences:
+                self.occ_row.append(row)
+                self.occ_code.append(code)
+            if self._occ_index is not None:
+                self._occ_index[row].extend(occurrences)
+        self.cd_resposta[row] = int(cd_resposta)
+        if nr_recibo:
+            start = row * RECIBO_SIZE
+            self.recibos[start:start + RECIBO_SIZE] = _fixed(nr_recibo, RECIBO_SIZE, 'nrRecibo')
+        return row
+
+    def add_retrieve(self, result):
+        """Store the event results of a `WSClient.retrieve` response (the
+        returned lxml Element, or a RawResponse). Returns how many events
+        were updated.
+        """
+        if hasattr(result, 'result'):
+            result = result.result
+        employer = _text(result, './/{*}retornoProcessamentoLoteEventos/{*}ideEmpregador/{*}nrInsc')
+        count = 0
+        for evento in result.iter('{*}evento'):
+            event_id = evento.get('Id')
+            processamento = evento.find('.//{*}retornoEvento/{*}processamento')
+            if event_id is None or processamento is None:
+                continue
+            occurrences = []
+            for codigo in processamento.iterfind('{*}ocorrencias/{*}ocorrencia/{*}codigo'):
+                try:
+                    occurrences.append(int(codigo.text))
+                except (TypeError, ValueError):
+                    occurrences.append(-1)
+            self.update(
+                event_id,
+                _text(processamento, '{*}cdResposta'),
+                nr_recibo=_text(evento, './/{*}retornoEvento/{*}recibo/{*}nrRecibo'),
+                occurrences=occurrences,
+                employer=employer,
+            )
+            count += 1
+        return count
+
+    def record(self, row):
+        """Return a row as a dict.
+        """
+        occurrences = list(self._occurrence_index().get(row, ()))
+        return {
+            'event_id': bytes(self.ids[row * ID_SIZE:(row + 1) * ID_SIZE]).rstrip(b'\0').decode('ascii'),
+            'employer': self.employers[self.employer[row]],
+            'event_type': self.event_types[self.event_type[row]],
+            'period': self.periods[self.period[row]],
+            'cd_resposta': int(self.cd_resposta[row]),
+            'nr_recibo': bytes(self.recibos[row * RECIBO_SIZE:(row + 1) * RECIBO_SIZE]).rstrip(b'\0').decode('ascii'),
+            'occurrences': occurrences,
+        }
+
+    def _counts(self, by):
+        """Return {group key tuple: [total, accepted, pending]}.
+        """
+        columns = [getattr(self, column) for column in by]
+        sizes = [len(self._tables()[column]) for column in by]
+        if numpy is not None and len(self):
+            keys = numpy.zeros(len(self), dtype=numpy.int64)
+            for column, size in zip(columns, sizes):
+                keys = keys * size + numpy.asarray(column, dtype=numpy.int64)
+            codes = numpy.asarray(self.cd_resposta)
+            accepted = numpy.isin(codes, ACCEPTED_CODES)
+            pending = codes == 0
+            uniq, inverse = numpy.unique(keys, return_inverse=True)
+            totals = numpy.bincount(inverse)
+            accepted = numpy.bincount(inverse, weights=accepted)
+            pending = numpy.bincount(inverse, weights=pending)
+            counts = {}
+            for i, key in enumerate(uniq.tolist()):
+                group = []
+                for size in reversed(sizes):
+                    key, code = divmod(key, size)
+                    group.append(code)
+                counts[tuple(reversed(group))] = [int(totals[i]), int(accepted[i]), int(pending[i])]
+            return counts
+        counts = defaultdict(lambda: [0, 0, 0])
+        for values in zip(self.cd_resposta, *columns):
+            item = counts[values[1:]]
+            item[0] += 1
+            if values[0] in ACCEPTED_CODES:
+                item[1] += 1
+            elif values[0] == 0:
+                item[2] += 1
+        return counts
+
+    def summary(self, by=_GROUP_COLUMNS):
+        """Aggregate the results by any of 'employer', 'event_type' and
+        'period'. Returns a list of dicts with the group values and 'total',
+        'accepted', 'rejected', 'pending' and 'acceptance_rate' (accepted /
+        processed, None when nothing was processed).
+        """
+        by = tuple(by)
+        for column in by:
+            if column not in _GROUP_COLUMNS:
+                raise ValueError('Can not group by "{}".'.format(column))
+        tables = self._tables()
+        rows = []
+        for group, (total, accepted, pending) in sorted(self._counts(by).items()):
+            row = dict((column, tables[column][code]) for column, code in zip(by, group))
+            processed = total - pending
+            row.update({
+                'total': total,
+                'accepted': accepted,
+                'rejected': processed - accepted,
+                'pending': pending,
+                'acceptance_rate': float(accepted) / processed if processed else None,
+            })
+            rows.append(row)
+        return rows
+
+    def save(self, path):
+        """Save the ledger to the directory `path`: one raw file per column
+        and a meta.json with the interned values.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'ids.bin'), 'wb') as fp:
+            fp.write(bytes(self.ids))
+        with open(os.path.join(path, 'recibos.bin'), 'wb') as fp:
+            fp.write(bytes(self.recibos))
+        for column in _INT_COLUMNS:
+            with open(os.path.join(path, '{}.i4'.format(column)), 'wb') as fp:
+                getattr(self, column).tofile(fp)
+        meta = {
+            'rows': len(self),
+            'byteorder': sys.byteorder,
+            'itemsize': array('i').itemsize,
+            'employers': self.employers,
+            'event_types': self.event_types,
+            'periods': self.periods,
+        }
+        with open(os.path.join(path, 'meta.json'), 'w') as fp:
+            json.dump(meta, fp)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """Load a ledger saved with `save`.
+
+        With `mmap_mode` set ('r' or 'c'), the event Id and nrRecibo columns
+        (and, with NumPy installed, all the other columns) are memory mapped
+        instead of read; the ledger is then read only ('r') or copy on write
+        ('c') and can not grow.
+        """
+        with open(os.path.join(path, 'meta.json')) as fp:
+            meta = json.load(fp)
+        ledger = cls()
+        ledger.employers = meta['employers']
+        ledger.event_types = meta['event_types']
+        ledger.periods = meta['periods']
+        for column in ('employer', 'event_type', 'period'):
+            ledger._codes[column] = dict((v, i) for i, v in enumerate(ledger._tables()[column]))
+        swap = meta['byteorder'] != sys.byteorder
+        for column in _INT_COLUMNS:
+            column_file = os.path.join(path, '{}.i4'.format(column))
+            if mmap_mode and numpy is not None:
+                dtype = numpy.dtype('<i4' if meta['byteorder'] == 'little' else '>i4')
+                if os.path.getsize(column_file):
+                    values = numpy.memmap(column_file, dtype=dtype, mode=mmap_mode)
+                else:
+                    # Empty files can not be mapped
+                    values = numpy.zeros(0, dtype=dtype)
+            else:
+                values = array('i')
+                with open(column_file, 'rb') as fp:
+                    values.fromfile(fp, os.path.getsize(column_file) // values.itemsize)
+                if swap:
+                    values.byteswap()
+            setattr(ledger, column, values)
+        ledger.ids = _load_bytes(os.path.join(path, 'ids.bin'), mmap_mode)
+        ledger.recibos = _load_bytes(os.path.join(path, 'recibos.bin'), mmap_mode)
+        return ledger
@@ -0,0 +1,96 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import os
+import datetime
+
+from unittest import TestCase
+
+from lxml import etree
+
+from esocial import codegen
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def _s2220(evt):
+    return evt.ESocial(evtMonit=evt.EvtMonit(
+        Id='IDTNNNNNNNNNNNNNNAAAAMMDDHHMMSSQQQQQ',
+        ideEvento=evt.TIdeEveTrab(indRetif=2, nrRecibo='TEST123456', tpAmb=2, procEmi=1, verProc='0.0.1'),
+        ideEmpregador=evt.TEmpregador(tpInsc=1, nrInsc='12345678901234'),
+        ideVinculo=evt.TIdeVinculoEstag(cpfTrab='12345678901', nisTrab='12345678901', matricula='123456'),
+        aso=evt.Aso(
+            dtAso=datetime.date(2018, 4, 1),
+            tpAso=1,
+            resAso=1,
+            exame=[evt.Exame(
+                dtExm=datetime.date(2018, 3, 25),
+                procRealizado=12345678,
+                obsProc='Descricao do procedimento caso nao tenha procRealizado',
+                interprExm=1,
+                ordExame=2,
+                dtIniMonit=datetime.date(2017, 4, 12),
+                dtFimMonit=datetime.date(2018, 4, 12),
+                indResult=1,
+                respMonit=evt.RespMonit(nisResp='12345678901', nrConsClasse='12345678', ufConsClasse='SC'),
+            )],
+            ideServSaude=evt.IdeServSaude(
+                codCNES='nao_obr',
+                frmCtt='Campo sinistro',
+                email='servsaude@example.com',
+                medico=evt.TMedico(nmMed='Menino Juka', crm=evt.TCrm(nrCRM='12345678', ufCRM='SC')),
+            ),
+        ),
+    ))
+
+
+class TestCodegen(TestCase):
+
+    def test_build_S2220(self):
+        evt = codegen.event_module('evtMonit', version='2.4.02')
+        parser = etree.XMLParser(remove_blank_text=True)
+        expected = etree.parse(os.path.join(here, 'xml', 'S-2220_not_signed.xml'), parser)
+        built = _s2220(evt).to_tree()
+        self.assertEqual(etree.tostring(built, method='c14n'), etree.tostring(expected, method='c14n'))
+
+    def test_structural_errors(self):
+        evt = codegen.event_module('evtMonit', version='2.4.02')
+        self.assertRaises(AttributeError, evt.TEmpregador, tpInscr=1)
+        root = _s2220(evt)
+        # Facets and element classes are checked on assignment
+        self.assertRaises(ValueError, setattr, root.evtMonit.ideEmpregador, 'tpInsc', 12)
+        self.assertRaises(ValueError, evt.TEmpregador, nrInsc='1234')
+        self.assertRaises(ValueError, setattr, root.evtMonit.aso, 'exame', [evt.TMedico()])
+        self.assertRaises(ValueError, setattr, root.evtMonit.aso, 'exame', evt.Exame())
+        self.assertRaises(ValueError, setattr, root.evtMonit, 'aso', evt.TMedico())
+        # Occurrences and later changes to lists are checked when building
+        root.evtMonit.ideVinculo = None
+        self.assertRaises(ValueError, root.to_tree)
+        root = _s2220(evt)
+        root.evtMonit.aso.exame.append(evt.TMedico())
+        self.assertRaises(ValueError, root.to_tree)
+
+    def test_all_events(self):
+        for event in codegen.events():
+            module = codegen.event_module(event)
+            self.assertEqual(etree.QName(module.ROOT._qname).localname, 'eSocial')
+            self.assertEqual(module.EVENT.__name__.lower(), event.lower())
+
+    def test_choice(self):
+        evt = codegen.event_module('evtTabRubrica')
+        info = evt.InfoRubrica()
+        self.assertRaises(ValueError, info.build, etree.Element('infoRubrica'))
+        info.inclusao = evt.Inclusao()
+        info.exclusao = evt.Exclusao()
+        self.assertRaises(ValueError, info.build, etree.Element('infoRubrica'))
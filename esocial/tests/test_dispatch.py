@@ -0,0 +1,224 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import os
+import time
+
+from unittest import TestCase
+
+from lxml import etree
+
+from esocial import xml, throttle
+from esocial.client import WSClient, RawResponse
+from esocial.dispatch import Dispatcher
+
+
+class FakeClient(object):
+
+    def __init__(self, employer_id=None, **kwargs):
+        self.employer_id = employer_id
+        self.batch = []
+
+    def clear_batch(self):
+        self.batch = []
+
+    def add_event(self, event):
+        if event.getroot().get('bad'):
+            raise ValueError('bad event')
+        self.batch.append(event)
+
+    def send(self, group_id=1):
+        return xml.create_root_element('retornoEnvio')
+
+
+class EnvelopClient(WSClient):
+    """WSClient that numbers events and builds the batch envelope, without
+    signing or sending."""
+
+    def __init__(self, employer_id=None, **kwargs):
+        if employer_id['nrInsc'] == 'bad':
+            raise ValueError('bad employer')
+        super(EnvelopClient, self).__init__(employer_id=employer_id, sender_id=employer_id)
+
+    def add_event(self, event):
+        event.getroot().getchildren()[0].set('Id', self._event_id())
+        self.batch.append(event)
+
+    def send(self, group_id=1):
+        return self._make_send_envelop(group_id)
+
+
+class RawClient(FakeClient):
+
+    def send(self, group_id=1):
+        return RawResponse(b'<cdResposta>201</cdResposta>')
+
+
+class DyingClient(FakeClient):
+
+    def __init__(self, employer_id=None, **kwargs):
+        os._exit(3)
+
+
+class FailingClient(FakeClient):
+    """The first send fails, after the throttle's retries."""
+
+    def __init__(self, employer_id=None, **kwargs):
+        super(FailingClient, self).__init__(employer_id=employer_id)
+        self.sends = 0
+
+    def send(self, group_id=1):
+        self.sends += 1
+        if self.sends == 1:
+            raise IOError('send failed')
+        return xml.create_root_element('retornoEnvio', sends=str(self.sends))
+
+
+class ThrottleClient(FakeClient):
+
+    def send(self, group_id=1):
+        return xml.create_root_element('retornoEnvio', cert_rate=str(throttle.default_throttle().cert_rate))
+
+
+def _event(n, bad=False):
+    root = xml.create_root_element('eSocial', bad='1') if bad else xml.create_root_element('eSocial')
+    xml.add_element(root, None, 'evt', Id=str(n))
+    return etree.ElementTree(root)
+
+
+class TestDispatcher(TestCase):
+
+    def test_order_by_employer_and_group(self):
+        employers = [{'tpInsc': 1, 'nrInsc': '{:014d}'.format(i)} for i in range(4)]
+        with Dispatcher(workers=3, max_batch_size=5, client_class=FakeClient) as dispatcher:
+            n = 0
+            for _ in range(20):
+                for employer_id in employers:
+                    for group_id in (1, 2):
+                        dispatcher.submit(employer_id, _event(n), group_id=group_id)
+                        n += 1
+            dispatcher.submit(employers[0], _event(n, bad=True))
+            results = dispatcher.close()
+            stats = dispatcher.stats()
+        self.assertEqual(sum(s['processed'] for s in stats), n + 1)
+        self.assertEqual(sum(s['depth'] for s in stats), 0)
+        sent = {}
+        errors = []
+        for result in results:
+            self.assertTrue(len(result['event_ids']) <= 5)
+            sent.setdefault((result['employer_id']['nrInsc'], result['group_id']), []).extend(
+                int(i) for i in result['event_ids']
+            )
+            errors.extend(result['errors'])
+        self.assertEqual(len(sent), 8)
+        for ids in sent.values():
+            self.assertEqual(len(ids), 20)
+            self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(errors), 1)
+
+    def test_employer_and_event_ids(self):
+        full = {'tpInsc': 1, 'nrInsc': '12345678000199', 'use_full': True}
+        root = {'tpInsc': 1, 'nrInsc': '98765432000199'}
+        with Dispatcher(workers=2, max_batch_size=3, linger=0.05, client_class=EnvelopClient) as dispatcher:
+            for n in range(10):
+                for employer_id in (full, root):
+                    dispatcher.submit(employer_id, _event(n), group_id=1 + n % 2)
+            dispatcher.submit({'tpInsc': 1, 'nrInsc': 'bad'}, _event(0))
+            results = dispatcher.close()
+        ids = {}
+        errors = []
+        for result in results:
+            errors.extend(result['errors'])
+            if result['result'] is None:
+                continue
+            envelop = etree.fromstring(result['result'])
+            nr_insc = envelop.xpath('//*[local-name()="ideEmpregador"]/*[local-name()="nrInsc"]/text()')[0]
+            self.assertEqual(nr_insc, result['employer_id']['nrInsc'][:8 if not result['employer_id'].get('use_full') else 14])
+            ids.setdefault(nr_insc, []).extend(result['event_ids'])
+        self.assertEqual(sorted(ids), ['12345678000199', '98765432'])
+        for event_ids in ids.values():
+            self.assertEqual(len(event_ids), 10)
+            self.assertEqual(len(set(event_ids)), 10)
+        self.assertEqual(errors, ["ValueError('bad employer')"])
+
+    def test_dead_worker(self):
+        dispatcher = Dispatcher(workers=1, client_class=DyingClient, linger=0)
+        dispatcher.submit({'tpInsc': 1, 'nrInsc': '12345678000199'}, _event(1))
+        results = dispatcher.close()
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['shard'], 0)
+        self.assertTrue('1 events not sent' in results[0]['errors'][0])
+
+    def test_raw_response(self):
+        with Dispatcher(workers=1, linger=0, client_class=RawClient) as dispatcher:
+            dispatcher.submit({'tpInsc': 1, 'nrInsc': '12345678000199'}, _event(1))
+            results = dispatcher.close()
+        self.assertEqual(results[0]['errors'], [])
+        self.assertEqual(results[0]['result'], b'<cdResposta>201</cdResposta>')
+
+    def test_block_after_failure(self):
+        employer_id = {'tpInsc': 1, 'nrInsc': '12345678000199'}
+        with Dispatcher(workers=1, max_batch_size=2, linger=5, client_class=FailingClient) as dispatcher:
+            events = [_event(n) for n in range(4)]
+            for event in events:
+                dispatcher.submit(employer_id, event)
+            first = dispatcher.get_result(timeout=5)
+            second = dispatcher.get_result(timeout=5)
+            dispatcher.unblock(employer_id)
+            for event in events:
+                dispatcher.submit(employer_id, event)
+            results = dispatcher.close()
+        self.assertTrue('send failed' in first['errors'][0])
+        self.assertEqual(first['unsent'], [etree.tostring(e) for e in events[:2]])
+        # The second batch never reached send()
+        self.assertEqual(second['event_ids'], [])
+        self.assertEqual(second['unsent'], [etree.tostring(e) for e in events[2:]])
+        self.assertTrue(second['errors'][0].startswith('Not sent'))
+        self.assertEqual([etree.fromstring(r['result']).get('sends') for r in results], ['2', '3'])
+        self.assertEqual([r['event_ids'] for r in results], [['0', '1'], ['2', '3']])
+
+    def test_rejected_event_blocks(self):
+        employer_id = {'tpInsc': 1, 'nrInsc': '12345678000199'}
+        events = [_event(0), _event(1, bad=True), _event(2)]
+        with Dispatcher(workers=1, max_batch_size=3, client_class=FakeClient) as dispatcher:
+            for event in events:
+                dispatcher.submit(employer_id, event)
+            results = dispatcher.close()
+        self.assertEqual(results[0]['event_ids'], ['0'])
+        self.assertEqual(results[0]['unsent'], [etree.tostring(e) for e in events[1:]])
+
+    def test_throttle_per_worker(self):
+        ctl = throttle.Throttle(endpoint_rates={'send': 10}, cert_rate=4)
+        self.assertEqual(ctl.settings(2)['cert_rate'], 2)
+        self.assertEqual(ctl.settings(2)['endpoint_rates'], {'send': 5})
+        with Dispatcher(workers=2, linger=0, client_class=ThrottleClient, throttle=ctl) as dispatcher:
+            dispatcher.submit({'tpInsc': 1, 'nrInsc': '12345678000199'}, _event(1))
+            results = dispatcher.close()
+        self.assertEqual(etree.fromstring(results[0]['result']).get('cert_rate'), '2.0')
+
+    def test_lag_per_pair(self):
+        with Dispatcher(workers=1, max_batch_size=5, linger=5, client_class=FakeClient) as dispatcher:
+            dispatcher.submit({'tpInsc': 1, 'nrInsc': '11111111000199'}, _event(0))
+            time.sleep(0.3)
+            for n in range(5):
+                dispatcher.submit({'tpInsc': 1, 'nrInsc': '22222222000199'}, _event(n))
+            dispatcher.get_result(timeout=5)
+            stats = dispatcher.stats()[0]
+            dispatcher.close()
+        self.assertEqual(stats['depth'], 1)
+        self.assertTrue(stats['lag'] >= 0.3)
+
+    def test_max_batch_size(self):
+        self.assertRaises(ValueError, Dispatcher, max_batch_size=51)
+        self.assertRaises(ValueError, Dispatcher, max_batch_size=0)
@@ -0,0 +1,157 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import mmap
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from lxml import etree
+
+from esocial import ledger
+
+
+def _event(event_id, evt, nr_insc, per_apur=None):
+    ns = 'http://www.esocial.gov.br/schema/evt/{}/v02_05_00'.format(evt)
+    per = '<perApur>{}</perApur>'.format(per_apur) if per_apur else ''
+    return etree.ElementTree(etree.fromstring(
+        '<eSocial xmlns="{ns}"><{evt} Id="{id}"><ideEvento>{per}</ideEvento>'
+        '<ideEmpregador><tpInsc>1</tpInsc><nrInsc>{nr}</nrInsc></ideEmpregador></{evt}></eSocial>'.format(
+            ns=ns, evt=evt, id=event_id, per=per, nr=nr_insc
+        )
+    ))
+
+
+def _retrieve(results):
+    eventos = ''.join(
+        '<evento Id="{}"><retornoEvento><eSocial><retornoEvento><processamento>'
+        '<cdResposta>{}</cdResposta>{}</processamento>{}</retornoEvento></eSocial></retornoEvento></evento>'.format(
+            event_id, cd,
+            '<ocorrencias>{}</ocorrencias>'.format(''.join(
+                '<ocorrencia><codigo>{}</codigo></ocorrencia>'.format(c) for c in occ
+            )) if occ else '',
+            '<recibo><nrRecibo>{}</nrRecibo></recibo>'.format(recibo) if recibo else '',
+        )
+        for event_id, cd, recibo, occ in results
+    )
+    return etree.fromstring(
+        '<eSocial><retornoProcessamentoLoteEventos><ideEmpregador><nrInsc>11111111</nrInsc></ideEmpregador>'
+        '<retornoEventos>{}</retornoEventos></retornoProcessamentoLoteEventos></eSocial>'.format(eventos)
+    )
+
+
+def _id(n):
+    return 'ID1111111110000002018010112000000{:03d}'.format(n)
+
+
+class TestLedger(TestCase):
+
+    def _ledger(self):
+        book = ledger.Ledger()
+        book.add_batch([
+            _event(_id(1), 'evtRemun', '11111111', '2018-01'),
+            _event(_id(2), 'evtRemun', '11111111', '2018-01'),
+            _event(_id(3), 'evtMonit', '11111111'),
+            _event(_id(4), 'evtMonit', '22222222'),
+        ])
+        book.add_retrieve(_retrieve([
+            (_id(1), 201, '1.1.0000000000000000001', []),
+            (_id(2), 401, None, [123, 456]),
+            (_id(3), 202, '1.1.0000000000000000003', [9]),
+        ]))
+        return book
+
+    def test_results(self):
+        book = self._ledger()
+        self.assertEqual(len(book), 4)
+        record = book.record(book.find(_id(2)))
+        self.assertEqual(record['event_type'], 'evtRemun')
+        self.assertEqual(record['period'], '2018-01')
+        self.assertEqual(record['cd_resposta'], 401)
+        self.assertEqual(record['occurrences'], [123, 456])
+        self.assertEqual(book.record(book.find(_id(1)))['nr_recibo'], '1.1.0000000000000000001')
+        self.assertEqual(book.record(book.find(_id(4)))['cd_resposta'], 0)
+
+    def test_summary(self):
+        book = self._ledger()
+        summary = book.summary(by=('employer', 'event_type'))
+        self.assertEqual(summary, [
+            {'employer': '11111111', 'event_type': 'evtRemun', 'total': 2, 'accepted': 1, 'rejected': 1,
+             'pending': 0, 'acceptance_rate': 0.5},
+            {'employer': '11111111', 'event_type': 'evtMonit', 'total': 1, 'accepted': 1, 'rejected': 0,
+             'pending': 0, 'acceptance_rate': 1.0},
+            {'employer': '22222222', 'event_type': 'evtMonit', 'total': 1, 'accepted': 0, 'rejected': 0,
+             'pending': 1, 'acceptance_rate': None},
+        ])
+        self.assertRaises(ValueError, book.summary, by=('nrRecibo',))
+
+    def test_save_load(self):
+        book = self._ledger()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            book.save(tmp_dir)
+            for mmap_mode in (None, 'r'):
+                loaded = ledger.Ledger.load(tmp_dir, mmap_mode=mmap_mode)
+                self.assertEqual(loaded.summary(), book.summary())
+                self.assertEqual(loaded.record(loaded.find(_id(2))), book.record(book.find(_id(2))))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def _big_ledger(self):
+        book = ledger.Ledger()
+        for n in range(500):
+            book.add(_id(n), str(n % 7), 'evt{}'.format(n % 5), '2018-{:02d}'.format(n % 12 + 1))
+            if n % 3:
+                book.update(_id(n), (201, 202, 401)[n % 3], occurrences=[n])
+        return book
+
+    def test_summary_numpy_and_fallback(self):
+        if ledger.numpy is None:
+            self.skipTest('numpy is not installed')
+        book = self._big_ledger()
+        vectorized = book.summary()
+        numpy_module = ledger.numpy
+        ledger.numpy = None
+        try:
+            fallback = book.summary()
+        finally:
+            ledger.numpy = numpy_module
+        self.assertEqual(vectorized, fallback)
+        self.assertEqual(book.record(book.find(_id(4)))['occurrences'], [4])
+
+    def test_load_memmap(self):
+        if ledger.numpy is None:
+            self.skipTest('numpy is not installed')
+        book = self._big_ledger()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            book.save(tmp_dir)
+            loaded = ledger.Ledger.load(tmp_dir, mmap_mode='r')
+            self.assertTrue(isinstance(loaded.cd_resposta, ledger.numpy.memmap))
+            self.assertTrue(isinstance(loaded.ids, mmap.mmap))
+            self.assertTrue(isinstance(loaded.recibos, mmap.mmap))
+            numpy_module = ledger.numpy
+            ledger.numpy = None
+            try:
+                fallback = ledger.Ledger.load(tmp_dir, mmap_mode='r')
+                fallback_summary = fallback.summary()
+            finally:
+                ledger.numpy = numpy_module
+            self.assertEqual(loaded.summary(), book.summary())
+            self.assertEqual(fallback_summary, book.summary())
+            self.assertEqual(loaded.record(loaded.find(_id(5))), book.record(book.find(_id(5))))
+            del loaded, fallback
+        finally:
+            shutil.rmtree(tmp_dir)
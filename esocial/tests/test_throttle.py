@@ -0,0 +1,102 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import requests
+
+from unittest import TestCase
+
+from lxml import etree
+
+from esocial import throttle
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestThrottle(TestCase):
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = throttle.TokenBucket(2.0, burst=2, clock=clock.time, sleep=clock.sleep)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual(clock.sleeps, [])
+        bucket.acquire()
+        self.assertAlmostEqual(clock.now, 0.5)
+
+    def test_aimd_limiter(self):
+        limiter = throttle.AIMDLimiter(initial=4, minimum=1, maximum=5, latency_target=1.0)
+        limiter.on_failure()
+        self.assertEqual(limiter.limit, 2)
+        limiter.on_success(0.1)
+        self.assertEqual(limiter.limit, 2.5)
+        limiter.on_success(5.0)
+        self.assertEqual(limiter.limit, 1.25)
+        for _ in range(100):
+            limiter.on_success(0.1)
+        self.assertEqual(limiter.limit, 5)
+
+    def test_retry_transient(self):
+        clock = FakeClock()
+        ctl = throttle.Throttle(max_retries=2, retry_delay=1.0, clock=clock.time, sleep=clock.sleep)
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise requests.exceptions.ConnectionError()
+            return 'ok'
+        self.assertEqual(ctl.call('send', None, flaky), 'ok')
+        self.assertEqual(clock.sleeps, [1.0, 2.0])
+
+    def test_no_retry_on_error(self):
+        ctl = throttle.Throttle(max_retries=2)
+
+        def broken():
+            raise ValueError()
+        self.assertRaises(ValueError, ctl.call, 'send', None, broken)
+
+    def test_no_retry_on_ssl_error(self):
+        clock = FakeClock()
+        ctl = throttle.Throttle(max_retries=2, clock=clock.time, sleep=clock.sleep)
+        calls = []
+
+        def rejected():
+            calls.append(1)
+            raise requests.exceptions.SSLError()
+        self.assertRaises(requests.exceptions.SSLError, ctl.call, 'send', None, rejected)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(clock.sleeps, [])
+        self.assertFalse(throttle.is_transient(requests.exceptions.ProxyError()))
+        self.assertTrue(throttle.is_transient(requests.exceptions.ConnectionError()))
+
+    def test_retry_overload_code(self):
+        clock = FakeClock()
+        ctl = throttle.Throttle(max_retries=1, clock=clock.time, sleep=clock.sleep)
+        overload = etree.XML('<eSocial><status><cdResposta>301</cdResposta></status></eSocial>')
+        result = ctl.call('retrieve', b'cert', lambda: overload)
+        self.assertTrue(result is overload)
+        self.assertEqual(len(clock.sleeps), 1)
+        self.assertEqual(ctl.limiter('retrieve').limit, 1)
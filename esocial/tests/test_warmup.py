@@ -0,0 +1,75 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import os
+
+from unittest import TestCase
+
+from cryptography.hazmat.primitives.serialization import pkcs12
+from OpenSSL import crypto
+
+import esocial
+
+from esocial import xml
+from esocial import utils
+from esocial import codegen
+
+
+class TestWarmup(TestCase):
+
+    def test_preload(self):
+        report = esocial.preload(versions=['2.4.02'], events=['evtMonit'], builders=True)
+        kinds = set(item['kind'] for item in report.items)
+        self.assertEqual(kinds, set(['module', 'xsd', 'builder', 'signer']))
+        self.assertTrue(report.seconds > 0)
+        xsd_file = codegen.xsd_file('evtMonit', '2.4.02')
+        self.assertTrue(xml.xsd_fromfile(xsd_file) is xml.xsd_fromfile(xsd_file))
+        self.assertTrue(xml.signer() is xml.signer())
+
+    def test_pkcs12_cache(self):
+        cert_file = os.path.join(os.path.dirname(os.path.abspath(esocial.__file__)), 'certs', 'libesocial-cert-test.pfx')
+        loads = []
+
+        class FakePKCS12(object):
+            # crypto.load_pkcs12 is gone from recent pyOpenSSL releases
+            def __init__(self, data, password):
+                loads.append(password)
+                key, cert, _ = pkcs12.load_key_and_certificates(data, password)
+                self.pkey = crypto.PKey.from_cryptography_key(key)
+                self.cert = crypto.X509.from_cryptography(cert)
+
+            def get_privatekey(self):
+                return self.pkey
+
+            def get_certificate(self):
+                return self.cert
+
+        original = getattr(utils.crypto, 'load_pkcs12', None)
+        utils.crypto.load_pkcs12 = FakePKCS12
+        try:
+            first = utils.pkcs12_data(cert_file, 'cert@test')
+            first['key_str'] = None
+            second = utils.pkcs12_data(cert_file, 'cert@test')
+            # text and bytes passwords share the cache entry
+            third = utils.pkcs12_data(cert_file, u'cert@test')
+            fourth = utils.pkcs12_data(cert_file, b'cert@test')
+        finally:
+            if original is None:
+                del utils.crypto.load_pkcs12
+            else:
+                utils.crypto.load_pkcs12 = original
+        self.assertEqual(len(loads), 1)
+        self.assertTrue(second['key_str'] is not None)
+        self.assertEqual(third['cert_str'], fourth['cert_str'])
+        self.assertFalse(any('cert@test' in str(key) for key in utils._pkcs12_cache))
@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+import io
 import os
+import json
+import shutil
+import tempfile
 
 import esocial
 
@@ -22,6 +26,8 @@ from esocial import xml
 from esocial import client
 from esocial.utils import pkcs12_data
 
+from lxml import etree
+
 here = os.path.dirname(os.path.abspath(__file__))
 there = os.path.dirname(os.path.abspath(esocial.__file__))
 
@@ -71,3 +77,81 @@ class TestXML(TestCase):
         protocol_number = 'A.B.YYYYMM.NNNNNNNNNNNNNNNNNNN'
         batch_to_retrieve = ws._make_retrieve_envelop(protocol_number)
         ws.validate_envelop('retrieve', batch_to_retrieve)
+
+    def test_load_fromfiles(self):
+        files = [os.path.join(here, 'xml', 'S-2220.xml'), os.path.join(here, 'xml', 'S-2220_not_signed.xml')] * 5
+        expected = [xml.load_fromfile(f).getroot().tag for f in files]
+        self.assertEqual([t.getroot().tag for t in xml.load_fromfiles(files)], expected)
+        self.assertEqual([t.getroot().tag for t in xml.load_fromfiles(files, workers=3, chunksize=2)], expected)
+
+    def test_load_fromndjson(self):
+        with open(os.path.join(here, 'xml', 'S-2220_not_signed.xml'), 'rb') as fp:
+            evt_xml = fp.read().decode('utf-8')
+        evt_json = {'eSocial': {'__ATTRS__': {'xmlns': 'http://example.com/ns'}, 'evtMonit': {'a': '1'}}}
+        lines = [json.dumps(evt_xml), '', json.dumps(evt_json)]
+        content = '\n'.join(lines).encode('utf-8')
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            ndjson_file = os.path.join(tmp_dir, 'events.ndjson')
+            with open(ndjson_file, 'wb') as fp:
+                fp.write(content)
+            for source in (ndjson_file, io.BytesIO(content)):
+                events = list(xml.load_fromndjson(source, workers=2, buffer_size=64))
+                self.assertEqual(len(events), 2)
+                self.assertEqual(events[0].getroot().getchildren()[0].get('Id'), 'IDTNNNNNNNNNNNNNNAAAAMMDDHHMMSSQQQQQ')
+                self.assertEqual(events[1].getroot().findtext('{http://example.com/ns}evtMonit/{http://example.com/ns}a'), '1')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_raw_soap(self):
+        ws = client.WSClient(raw=True)
+        protocol_number = 'A.B.YYYYMM.NNNNNNNNNNNNNNNNNNN'
+        batch_to_retrieve = ws._make_retrieve_envelop(protocol_number)
+        soap = etree.fromstring(ws._soap_envelop('retrieve', etree.tostring(batch_to_retrieve)))
+        self.assertEqual(soap.xpath('//*[local-name()="protocoloEnvio"]/text()'), [protocol_number])
+        response = client.RawResponse(
+            b'<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>'
+            b'<ConsultarLoteEventosResponse><ConsultarLoteEventosResult>'
+            b'<eSocial><retornoProcessamentoLoteEventos><status><cdResposta>201</cdResposta>'
+            b'</status></retornoProcessamentoLoteEventos></eSocial>'
+            b'</ConsultarLoteEventosResult></ConsultarLoteEventosResponse></s:Body></s:Envelope>'
+        )
+        self.assertEqual(response.response_code(), '201')
+        self.assertEqual(response.result.tag, 'eSocial')
+        response = client.RawResponse(b'<s:Envelope><cdResposta xmlns="urn:x">301</cdResposta></s:Envelope>')
+        self.assertEqual(response.response_code(), '301')
+
+    def test_raw_post_timeout(self):
+        posts = []
+
+        class FakeHTTPResponse(object):
+            status_code = 200
+            content = b'<cdResposta>201</cdResposta>'
+
+        class FakeSession(object):
+            def post(self, url, **kwargs):
+                posts.append(kwargs)
+                return FakeHTTPResponse()
+        ws = client.WSClient(raw=True, timeout=12)
+        ws._session = FakeSession()
+        response = ws._post_raw('retrieve', b'<eSocial/>')
+        self.assertEqual(response.response_code(), '201')
+        self.assertEqual(posts[0]['timeout'], 12)
+
+    def test_load_fromfiles_bounded(self):
+        requested = []
+
+        def files():
+            for i in range(1000):
+                requested.append(i)
+                yield os.path.join(here, 'xml', 'S-2220.xml')
+        trees = xml.load_fromfiles(files(), workers=2, chunksize=4)
+        next(trees)
+        trees.close()
+        self.assertTrue(len(requested) <= 2 * 4 + 1, len(requested))
+
+    def test_event_id_sequence(self):
+        ws = client.WSClient(employer_id={'tpInsc': 1, 'nrInsc': '12345678000199'})
+        first = ws._event_id()
+        ws.clear_batch()
+        self.assertNotEqual(ws._event_id(), first)
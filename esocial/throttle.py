@@ -0,0 +1,300 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Rate limiting, adaptive concurrency and retries for eSocial webservices.
+
+Every call made by `esocial.client.WSClient` goes through a `Throttle`. By
+default all clients in the process share the same instance (see
+`default_throttle`), so the limits apply to the process as a whole and not to
+each client object.
+"""
+import time
+import threading
+
+import requests
+
+from zeep.exceptions import TransportError
+
+
+# eSocial "cdResposta" codes meaning the server could not handle the request
+# right now ("Erro Servidor eSocial"). These are retried.
+OVERLOAD_CODES = ('301',)
+
+# HTTP status codes considered transient.
+TRANSIENT_HTTP_STATUS = (429, 500, 502, 503, 504)
+
+# Wall clock steps (NTP, manual changes) must not stall the rate limiters.
+# time.monotonic does not exist on Python 2.
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter.
+
+    Parameters
+    ----------
+    rate: float
+        Tokens (requests) added per second.
+    burst: int
+        Maximum number of tokens stored in the bucket.
+    """
+    def __init__(self, rate, burst=1, clock=_clock, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self._clock = clock
+        self._sleep = sleep
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = now - self._last
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self._last = now
+
+    def try_acquire(self):
+        """Take a token if available. Returns the seconds to wait otherwise.
+        """
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available.
+        """
+        wait = self.try_acquire()
+        while wait > 0:
+            self._sleep(wait)
+            wait = self.try_acquire()
+
+
+class AIMDLimiter(object):
+    """Concurrency limiter with additive increase, multiplicative decrease.
+
+    The limit grows by `increase` / `limit` on every fast successful call
+    (about `increase` per round of `limit` calls) and is multiplied by
+    `decrease` on every failure or slow call.
+
+    Parameters
+    ----------
+    initial: int
+        Starting concurrency limit.
+    minimum, maximum: int
+        Bounds for the concurrency limit.
+    latency_target: float
+        Calls slower than this (in seconds) are treated as congestion.
+    increase: float
+        Additive step.
+    decrease: float
+        Multiplicative factor, between 0 and 1.
+    """
+    def __init__(self, initial=4, minimum=1, maximum=16, latency_target=10.0,
+                 increase=1.0, decrease=0.5):
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.latency_target = latency_target
+        self.increase = increase
+        self.decrease = decrease
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self, latency):
+        if self.latency_target is not None and latency > self.latency_target:
+            self.on_failure()
+            return
+        with self._cond:
+            self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            self._cond.notify_all()
+
+    def on_failure(self):
+        with self._cond:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+def is_transient(exc):
+    """Whether an exception raised by a webservice call may be retried.
+    """
+    # Subclasses of ConnectionError, but retrying a rejected certificate or a
+    # broken proxy setup only delays the error and shrinks the limits.
+    if isinstance(exc, (requests.exceptions.SSLError, requests.exceptions.ProxyError)):
+        return False
+    if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(exc, TransportError):
+        return exc.status_code in TRANSIENT_HTTP_STATUS
+    return False
+
+
+def response_code(result):
+    """Return the "cdResposta" text of a webservice result, if there is one.
+    """
+    if hasattr(result, 'response_code'):
+        # esocial.client.RawResponse
+        return result.response_code()
+    if result is None or not hasattr(result, 'xpath'):
+        return None
+    codes = result.xpath('.//*[local-name()="cdResposta"]/text()')
+    if codes:
+        return codes[0].strip()
+    return None
+
+
+class Throttle(object):
+    """Shared controller for calls to the eSocial webservices.
+
+    Each call waits for a token from its endpoint bucket and from its
+    certificate bucket, then for a free slot in the endpoint concurrency
+    limiter. Transient failures (connection errors, timeouts, HTTP 429/5xx
+    and "cdResposta" in `OVERLOAD_CODES`) shrink the concurrency limit and
+    are retried with exponential backoff, re-sending exactly the same
+    payload, so events keep their Ids between attempts.
+
+    Parameters
+    ----------
+    endpoint_rates: dict, optional
+        Requests per second for each endpoint ('send', 'retrieve', ...).
+        Endpoints not listed are not rate limited.
+    cert_rate: float, optional
+        Requests per second for each certificate, across all endpoints.
+    burst: int
+        Bucket size for all rate limiters.
+    concurrency: dict, optional
+        Keyword arguments for every `AIMDLimiter`.
+    max_retries: int
+        How many times a transient failure is retried.
+    retry_delay: float
+        Seconds to wait before the first retry, doubled on each attempt.
+    """
+    def __init__(self, endpoint_rates=None, cert_rate=None, burst=1, concurrency=None,
+                 max_retries=3, retry_delay=1.0, clock=_clock, sleep=time.sleep):
+        self.endpoint_rates = dict(endpoint_rates or {})
+        self.cert_rate = cert_rate
+        self.burst = burst
+        self.concurrency = dict(concurrency or {})
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._clock = clock
+        self._sleep = sleep
+        self._endpoint_buckets = {}
+        self._cert_buckets = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def settings(self, parts=1):
+        """Return keyword arguments for a `Throttle` with 1/`parts` of the
+        rates and burst of this one, for each of `parts` processes that share
+        the same certificates (see `esocial.dispatch.Dispatcher`).
+        """
+        parts = float(parts)
+        return {
+            'endpoint_rates': dict(
+                (endpoint, rate / parts) for endpoint, rate in self.endpoint_rates.items()
+            ),
+            'cert_rate': self.cert_rate / parts if self.cert_rate is not None else None,
+            'burst': max(1, int(self.burst / parts)),
+            'concurrency': dict(self.concurrency),
+            'max_retries': self.max_retries,
+            'retry_delay': self.retry_delay,
+        }
+
+    def _bucket(self, buckets, key, rate):
+        if rate is None:
+            return None
+        with self._lock:
+            if key not in buckets:
+                buckets[key] = TokenBucket(rate, burst=self.burst, clock=self._clock, sleep=self._sleep)
+            return buckets[key]
+
+    def limiter(self, endpoint):
+        with self._lock:
+            if endpoint not in self._limiters:
+                self._limiters[endpoint] = AIMDLimiter(**self.concurrency)
+            return self._limiters[endpoint]
+
+    def _wait_rate(self, endpoint, cert_id):
+        bucket = self._bucket(self._endpoint_buckets, endpoint, self.endpoint_rates.get(endpoint))
+        if bucket is not None:
+            bucket.acquire()
+        if cert_id is not None:
+            bucket = self._bucket(self._cert_buckets, cert_id, self.cert_rate)
+            if bucket is not None:
+                bucket.acquire()
+
+    def call(self, endpoint, cert_id, func, *args, **kwargs):
+        """Call `func(*args, **kwargs)` under the limits of `endpoint` and `cert_id`.
+        """
+        limiter = self.limiter(endpoint)
+        attempt = 0
+        while True:
+            self._wait_rate(endpoint, cert_id)
+            limiter.acquire()
+            start = self._clock()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                limiter.release()
+                if not is_transient(e):
+                    raise
+                limiter.on_failure()
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                limiter.release()
+                if response_code(result) not in OVERLOAD_CODES:
+                    limiter.on_success(self._clock() - start)
+                    return result
+                limiter.on_failure()
+                if attempt >= self.max_retries:
+                    return result
+            self._sleep(self.retry_delay * (2 ** attempt))
+            attempt += 1
+
+
+_default_throttle = None
+_default_lock = threading.Lock()
+
+
+def default_throttle():
+    """Return the `Throttle` shared by all clients of this process.
+    """
+    global _default_throttle
+    with _default_lock:
+        if _default_throttle is None:
+            _default_throttle = Throttle()
+        return _default_throttle
+
+
+def set_default_throttle(throttle):
+    """Replace the `Throttle` shared by all clients of this process.
+    """
+    global _default_throttle
+    with _default_lock:
+        _default_throttle = throttle
@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+import os
+import hashlib
+
 import six
 
 from OpenSSL import crypto
@@ -30,18 +33,38 @@ def normalize_text(text):
     return text
 
 
+_pkcs12_cache = {}
+# Per process salt, so the cache keys can not be matched against precomputed
+# password digests
+_pkcs12_salt = os.urandom(16)
+
+
 def pkcs12_data(cert_file, password):
-    if six.PY3:
+    """Read a PKCS#12 (.pfx/.p12) file.
+
+    The result is cached by file path, modification time and a salted digest
+    of the password, so the file is decrypted only once per process (see
+    `esocial.preload`). Each call returns a new dict.
+    """
+    if isinstance(password, six.text_type):
         password = password.encode('utf-8')
-    with open(cert_file, 'rb') as fp:
-        content_pkcs12 = crypto.load_pkcs12(fp.read(), password)
-    pkey = content_pkcs12.get_privatekey()
-    cert_X509 = content_pkcs12.get_certificate()
-    key_str = crypto.dump_privatekey(crypto.FILETYPE_PEM, pkey)
-    cert_str = crypto.dump_certificate(crypto.FILETYPE_PEM, cert_X509)
-    return {
-        'key_str': key_str,
-        'cert_str': cert_str,
-        'key': pkey,
-        'cert': cert_X509,
-    }
+    key = (
+        os.path.abspath(cert_file),
+        os.path.getmtime(cert_file),
+        hashlib.sha256(_pkcs12_salt + password).hexdigest(),
+    )
+    if key not in _pkcs12_cache:
+        with open(cert_file, 'rb') as fp:
+            content_pkcs12 = crypto.load_pkcs12(fp.read(), password)
+        pkey = content_pkcs12.get_privatekey()
+        cert_X509 = content_pkcs12.get_certificate()
+        key_str = crypto.dump_privatekey(crypto.FILETYPE_PEM, pkey)
+        cert_str = crypto.dump_certificate(crypto.FILETYPE_PEM, cert_X509)
+        _pkcs12_cache[key] = {
+            'key_str': key_str,
+            'cert_str': cert_str,
+            'key': pkey,
+            'cert': cert_X509,
+            'crypto_key': pkey.to_cryptography_key(),
+        }
+    return dict(_pkcs12_cache[key])
@@ -0,0 +1,141 @@
+# Copyright 2018, Qualita Seguranca e Saude Ocupacional. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Pre-fork warm-up.
+
+Load everything a worker needs before the process forks (compiled XSD's,
+decrypted certificates, the XML signer and the webservice libraries), so the
+children inherit it through copy-on-write and do not pay for it on their
+first request.
+"""
+import os
+import time
+
+import esocial
+
+from esocial import xml
+from esocial import utils
+from esocial import codegen
+
+
+here = os.path.abspath(os.path.dirname(__file__))
+
+
+def _rss():
+    """Resident memory of the current process, in bytes, or None if unknown.
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+
+class PreloadReport(object):
+    """Timing and memory footprint of each preloaded item.
+
+    Each entry of `items` is a dict with the keys: 'kind' ('xsd', 'cert',
+    'signer', 'builder' or 'module'), 'name', 'seconds', 'memory' (bytes
+    of resident memory added while loading it, None if not available) and
+    'error' (the exception raised while loading it, or None).
+    """
+    def __init__(self):
+        self.items = []
+
+    def measure(self, kind, name, func, *args, **kwargs):
+        rss = _rss()
+        start = time.time()
+        result = None
+        error = None
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            # A broken item is reported and will fail again when used
+            error = e
+        seconds = time.time() - start
+        after = _rss()
+        self.items.append({
+            'kind': kind,
+            'name': name,
+            'seconds': seconds,
+            'memory': after - rss if rss is not None and after is not None else None,
+            'error': error,
+        })
+        return result
+
+    @property
+    def errors(self):
+        return [item for item in self.items if item['error'] is not None]
+
+    @property
+    def seconds(self):
+        return sum(item['seconds'] for item in self.items)
+
+    @property
+    def memory(self):
+        return sum(item['memory'] or 0 for item in self.items)
+
+    def __str__(self):
+        lines = ['{:<8} {:<60} {:>10} {:>12}'.format('kind', 'name', 'seconds', 'memory (KB)')]
+        for item in self.items:
+            memory = '-' if item['memory'] is None else '{:.0f}'.format(item['memory'] / 1024.0)
+            lines.append('{:<8} {:<60} {:>10.4f} {:>12}'.format(item['kind'], item['name'], item['seconds'], memory))
+            if item['error'] is not None:
+                lines.append('         error: {}'.format(item['error']))
+        lines.append('{:<8} {:<60} {:>10.4f} {:>12.0f}'.format('total', '', self.seconds, self.memory / 1024.0))
+        return '\n'.join(lines)
+
+
+def _webservice_xsds():
+    xsd_dir = os.path.join(here, 'xsd')
+    for which in sorted(esocial.__xsd_versions__):
+        version = esocial.__xsd_versions__[which]['version'].replace('.', '_')
+        yield os.path.join(xsd_dir, esocial.__xsd_versions__[which]['xsd'].format(version))
+
+
+def preload(versions=None, events=None, certs=None, builders=False):
+    """Load schemas, certificates and the XML signer into the process caches.
+
+    Parameters
+    ----------
+    versions: list of strings, optional
+        eSocial layout versions (e.g. ['2.5.00']). Default: the current one.
+    events: list of strings, optional
+        Event names (e.g. ['evtMonit', 'evtExpRisco']). Default: all events
+        of each version.
+    certs: list of (pfx_file, pfx_passw) tuples, optional
+        Certificates to decrypt. WSClient instances created later with the
+        same file and password reuse them.
+    builders: bool
+        Also generate the `esocial.codegen` event builder classes.
+
+    Returns
+    -------
+    PreloadReport
+    """
+    report = PreloadReport()
+    report.measure('module', 'esocial.client', __import__, 'esocial.client')
+    for xsd_file in _webservice_xsds():
+        report.measure('xsd', os.path.basename(xsd_file), xml.xsd_fromfile, xsd_file)
+    for version in versions or [esocial.__esocial_version__]:
+        for event in events or codegen.events(version):
+            xsd_file = codegen.xsd_file(event, version)
+            report.measure('xsd', 'v{}/{}'.format(version, event), xml.xsd_fromfile, xsd_file)
+            if builders:
+                report.measure('builder', 'v{}/{}'.format(version, event), codegen.event_module, event, version)
+    for pfx_file, pfx_passw in certs or []:
+        report.measure('cert', os.path.basename(pfx_file), utils.pkcs12_data, pfx_file, pfx_passw)
+    report.measure('signer', 'XMLSigner', xml.signer)
+    return report
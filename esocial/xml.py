@@ -13,11 +13,14 @@
 # limitations under the License.
 # ==============================================================================
 import os
-import types
+import mmap
 import codecs
 import json
+import threading
 
-from collections import OrderedDict
+from itertools import islice
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
 
 import six
 
@@ -79,10 +82,24 @@ class XMLValidate(object):
         self.xsd.assert_(self.xml_doc)
 
 
+_xsd_cache = {}
+_xsd_lock = threading.Lock()
+
+
 def xsd_fromfile(f):
-    with codecs.open(f, 'r', encoding='utf-8') as fxsd:
-        xmlschema = etree.parse(fxsd)
-    return etree.XMLSchema(xmlschema)
+    """Load a XSD file as a lxml.etree.XMLSchema object.
+
+    Compiled schemas are cached by file path, so each XSD is parsed only once
+    per process (see `esocial.preload`).
+    """
+    key = os.path.abspath(f)
+    xmlschema = _xsd_cache.get(key)
+    if xmlschema is None:
+        with codecs.open(f, 'r', encoding='utf-8') as fxsd:
+            xmlschema = etree.XMLSchema(etree.parse(fxsd))
+        with _xsd_lock:
+            xmlschema = _xsd_cache.setdefault(key, xmlschema)
+    return xmlschema
 
 
 def xsd_fromdoc(xml_doc):
@@ -162,9 +179,146 @@ def dump_tofile(root, xml_file, xml_declaration=True):
     fpxml.close()
 
 
+_parsers = threading.local()
+
+
+def _parser():
+    # lxml parsers can be reused, but not shared between threads
+    parser = getattr(_parsers, 'parser', None)
+    if parser is None:
+        parser = etree.XMLParser(ns_clean=True)
+        _parsers.parser = parser
+    return parser
+
+
 def load_fromfile(xml_file):
-    parser = etree.XMLParser(ns_clean=True)
-    return etree.parse(xml_file, parser)
+    return etree.parse(xml_file, _parser())
+
+
+def load_frombytes(data):
+    """Parse a XML document from bytes, bytearray, memoryview or mmap
+    objects, without copying it.
+    """
+    return etree.ElementTree(etree.fromstring(data, _parser()))
+
+
+def _load_mapped(xml_file):
+    with open(xml_file, 'rb') as fp:
+        try:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            # Empty files and special files can not be mapped
+            return load_frombytes(fp.read())
+    try:
+        return load_frombytes(mapped)
+    finally:
+        mapped.close()
+
+
+def _lazy_map(func, items, workers, chunksize):
+    if not workers:
+        for item in items:
+            yield func(item)
+        return
+    # lxml releases the GIL while parsing, so threads parse in parallel.
+    # Only a window of workers * chunksize items is read ahead of the caller,
+    # so parsed trees do not pile up in memory.
+    items = iter(items)
+    pool = ThreadPool(workers)
+    window = deque()
+    try:
+        for item in islice(items, workers * max(1, chunksize)):
+            window.append(pool.apply_async(func, (item,)))
+        while window:
+            result = window.popleft().get()
+            for item in islice(items, 1):
+                window.append(pool.apply_async(func, (item,)))
+            yield result
+    finally:
+        pool.terminate()
+
+
+def load_fromfiles(xml_files, workers=None, chunksize=16):
+    """Lazily parse many XML files, yielding one ElementTree per file, in
+    the same order as `xml_files`.
+
+    Files are read through mmap and parsed with a parser reused by each
+    thread.
+
+    Parameters
+    ----------
+    xml_files: iterable of file paths
+    workers: int, optional
+        Number of threads parsing files in parallel. If not provided, files
+        are parsed in the calling thread.
+    chunksize: int
+        Files in flight per worker: at most `workers * chunksize` files are
+        parsed ahead of the caller.
+    """
+    return _lazy_map(_load_mapped, xml_files, workers, chunksize)
+
+
+def _ndjson_lines(source, buffer_size):
+    if isinstance(source, six.string_types):
+        with open(source, 'rb') as fp:
+            try:
+                mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                mapped = None
+            if mapped is None:
+                for line in _ndjson_lines(fp, buffer_size):
+                    yield line
+                return
+        try:
+            start = 0
+            size = len(mapped)
+            while start < size:
+                end = mapped.find(b'\n', start)
+                if end < 0:
+                    end = size
+                yield mapped[start:end]
+                start = end + 1
+        finally:
+            mapped.close()
+    else:
+        pending = b''
+        while True:
+            chunk = source.read(buffer_size)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line
+        yield pending
+
+
+def _load_ndjson_line(line):
+    py_ = json.loads(line.decode('utf-8'), object_pairs_hook=OrderedDict)
+    if isinstance(py_, six.string_types):
+        return load_frombytes(py_.encode('utf-8'))
+    return load_fromjson(py_)
+
+
+def load_fromndjson(source, workers=None, chunksize=64, buffer_size=1024 * 1024):
+    """Lazily parse a NDJSON (one JSON value per line) stream of events,
+    yielding one ElementTree per line.
+
+    Each line is either a JSON string with the event XML, or a JSON object in
+    the format accepted by `load_fromjson`. Blank lines are skipped.
+
+    Parameters
+    ----------
+    source: file path or binary file-like object
+        Files are read through mmap, file-like objects in `buffer_size` chunks.
+    workers: int, optional
+        Number of threads parsing lines in parallel.
+    chunksize: int
+        Lines in flight per worker: at most `workers * chunksize` lines are
+        parsed ahead of the caller.
+    """
+    lines = (line for line in _ndjson_lines(source, buffer_size) if line.strip())
+    return _lazy_map(_load_ndjson_line, lines, workers, chunksize)
 
 
 def load_fromstring(xmlstring):
@@ -197,11 +351,11 @@ def _check_attrs(tag_dict):
 
 def recursive_add_element(root, element, nsmap_default={}):
     for ele_k in element:
-        if isinstance(element[ele_k], types.ListType):
+        if isinstance(element[ele_k], list):
             child = add_element(root, None, ele_k, ns=nsmap_default)
             for ele_i in element[ele_k]:
                 recursive_add_element(child, ele_i, nsmap_default=nsmap_default)
-        elif isinstance(element[ele_k], types.DictType):
+        elif isinstance(element[ele_k], dict):
             attrs, nsmap, value_attr = _check_attrs(element[ele_k])
             if value_attr:
                 add_element(root, None, ele_k, text=value_attr, ns=nsmap or nsmap_default, **attrs if attrs else {})
@@ -273,7 +427,7 @@ def load_fromjson(json_obj, root=None):
         has_root = False
         root_tag = root.copy() if root else None
         nsmap = {}
-        if isinstance(py_, types.DictType):
+        if isinstance(py_, dict):
             for k in py_:
                 if root_tag is None and not has_root:
                     attrs, nsmap, value_attr = _check_attrs(py_[k])
@@ -286,16 +440,33 @@ def load_fromjson(json_obj, root=None):
     return None
 
 
+_signers = threading.local()
+
+
+def signer():
+    """Return the XMLSigner of the current thread, configured with the
+    signature algorithms from eSocial documentation.
+    """
+    xml_signer = getattr(_signers, 'signer', None)
+    if xml_signer is None:
+        xml_signer = XMLSigner(
+            method=signxml.methods.enveloped,
+            signature_algorithm='rsa-sha256',
+            digest_algorithm='sha256',
+            c14n_algorithm='http://www.w3.org/TR/2001/REC-xml-c14n-20010315'
+        )
+        _signers.signer = xml_signer
+    return xml_signer
+
+
 def sign(xml, cert_data):
-    signer = XMLSigner(
-        method=signxml.methods.enveloped,
-        signature_algorithm='rsa-sha256',
-        digest_algorithm='sha256',
-        c14n_algorithm='http://www.w3.org/TR/2001/REC-xml-c14n-20010315'
-    )
     xml_root = None
     if not isinstance(xml, etree._ElementTree):
         xml = load_fromfile(xml)
     xml_root = xml.getroot()
-    signed_root = signer.sign(xml_root, key=cert_data['key_str'], cert=cert_data['cert_str'])
+    signed_root = signer().sign(
+        xml_root,
+        key=cert_data.get('crypto_key') or cert_data['key_str'],
+        cert=cert_data['cert_str']
+    )
     return etree.ElementTree(signed_root)
@@ -41,6 +41,10 @@ setup(
     packages=find_packages(exclude=['contrib', 'docs']),
     include_package_data=True,
     install_requires=install_requires,
+    extras_require={
+        # Vectorized esocial.ledger summaries and memory mapped columns
+        'ledger': ['numpy'],
+    },
     zip_safe=False,
     test_suite='nose.collector',
     tests_require=['nose'],